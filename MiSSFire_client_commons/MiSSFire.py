@@ -1,38 +1,408 @@
 import os
+import re
 import ssl
 import uuid
 import time
+import fcntl
+import Queue
+import base64
+import binascii
+import random
+import shutil
+import hashlib
+import urlparse
+import datetime
+import threading
+# strptime imports a module on first use, which fails in a background
+# thread while another thread holds the import lock (Python 2).
+import _strptime
 from functools import wraps
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, CancelledError, \
+                               TimeoutError as FuturesTimeoutError, wait
 from socket import error as socket_error
 
 import jwt
 import requests
-from flask import request, abort
+from requests.adapters import HTTPAdapter
+from flask import request, abort, Blueprint, g, has_app_context
 
+from cryptography import x509
 from cryptography.x509 import load_pem_x509_certificate
+from cryptography.x509.oid import NameOID
+from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, padding
 
-from general import log, getEnvVar, isDocker
+import metrics
+from missfire_config import getConfig
+from logger_client import log, requestId
 
 
-serviceType = os.path.basename(os.getcwd())
+# Settings come from the environment or the MISSFIRE_CONFIG file, see
+# missfire_config. Importing this module only reads them: the credentials
+# are obtained by the first use of secureRequests, see bootstrap().
+config = getConfig()
+# Type of this service, the prefix of the CN of its certificate
+serviceType = config.get('SERVICE_TYPE', os.path.basename(os.getcwd()))
 logger = log(serviceType).logger
-DEBUG = getEnvVar('SERVICE_DEBUG', False)
+DEBUG = config.get('SERVICE_DEBUG', False)
+# Obtain a service certificate and use MTLS for outbound calls
+MTLS = config.get('MTLS', False)
+# Verify the tokens of inbound requests and propagate them
+TOKEN = config.get('TOKEN', False)
+# 'rsa' or 'ec' generates the service key and CSR in-process, unset keeps
+# using the openssl command line tool.
+KEY_TYPE = config.get('SERVICE_KEY_TYPE')
+# Number of spare keys kept ready by a background thread, 0 disables it
+KEY_POOL_SIZE = config.get('SERVICE_KEY_POOL_SIZE', 0)
+# Directory of pre-generated keys that survives restarts, e.g. a volume
+KEY_CACHE_DIR = config.get('SERVICE_KEY_CACHE_DIR')
+# Number of keys kept in that directory, independent of the pool in memory
+KEY_CACHE_SIZE = config.get('SERVICE_KEY_CACHE_SIZE', 2)
+# Bootstrap in background threads instead of blocking the first use
+BOOTSTRAP_ASYNC = config.get('BOOTSTRAP_ASYNC', False)
+# Attempts per bootstrap step and the backoff between them, in seconds
+BOOTSTRAP_RETRIES = config.get('BOOTSTRAP_RETRIES', 10)
+BOOTSTRAP_BACKOFF = config.get('BOOTSTRAP_BACKOFF', 0.5)
+BOOTSTRAP_MAX_BACKOFF = config.get('BOOTSTRAP_MAX_BACKOFF', 30.0)
+# How long outbound calls wait for an unfinished bootstrap, in seconds
+BOOTSTRAP_WAIT = config.get('BOOTSTRAP_WAIT', 60.0)
+# Renew the service certificate in the background before it expires
+CERT_RENEWAL = config.get('CERT_RENEWAL', True)
+# Renew after this fraction of the certificate lifetime, plus/minus jitter
+CERT_RENEW_AT = config.get('CERT_RENEW_AT', 0.7)
+CERT_RENEW_JITTER = config.get('CERT_RENEW_JITTER', 0.1)
+# Reuse the certificate and key of a previous run instead of having a new
+# one signed, if they match, chain to the CA certificate and have more
+# than CERT_MIN_VALIDITY seconds left
+CERT_REUSE = config.get('CERT_REUSE', True)
+CERT_MIN_VALIDITY = config.get('CERT_MIN_VALIDITY', 600.0)
+# Directory that keeps the certificate and key across restarts, e.g. a
+# volume; the service directory is looked at first
+CERT_CACHE_DIR = config.get('CERT_CACHE_DIR')
+# Token algorithm used when the token service does not announce one
+JWT_ALGORITHM = config.get('JWT_ALGORITHM', 'RS256')
+# Asymmetric algorithms the token service may announce and tokens may use
+JWT_ALGORITHMS = config.get('JWT_ALGORITHMS',
+                            ['RS256', 'RS384', 'RS512', 'PS256', 'PS384',
+                             'PS512', 'ES256', 'ES384', 'ES512'])
+# Least time between two refreshes of the token keys, in seconds
+TOKEN_KEYS_REFRESH_INTERVAL = config.get('TOKEN_KEYS_REFRESH_INTERVAL', 5.0)
+# Verified tokens remembered by SecurityToken.validate, 0 disables the cache
+TOKEN_CACHE_SIZE = config.get('TOKEN_CACHE_SIZE', 1024)
+# Longest time a verified token is trusted without verifying it again
+TOKEN_CACHE_TTL = config.get('TOKEN_CACHE_TTL', 300.0)
+# Outbound connections kept alive per host, and number of hosts kept
+POOL_MAXSIZE = config.get('REQUESTS_POOL_MAXSIZE', 10)
+POOL_CONNECTIONS = config.get('REQUESTS_POOL_CONNECTIONS', 10)
+# Wait for a free pooled connection instead of opening an extra one that
+# is closed right after the request
+POOL_BLOCK = config.get('REQUESTS_POOL_BLOCK', False)
+# How outbound calls carry the token: 'json' in the 'access_token' field
+# of the body, 'header' as 'Authorization: Bearer', or 'both' while
+# services migrate. Inbound requests are accepted either way.
+TOKEN_PROPAGATION = config.get('TOKEN_PROPAGATION', 'json')
+# Threads sending the calls of ConcurrentRequests
+FANOUT_WORKERS = config.get('FANOUT_WORKERS', 16)
+# Concurrent calls to one host, by default as many as are kept alive
+FANOUT_HOST_LIMIT = config.get('FANOUT_HOST_LIMIT', POOL_MAXSIZE)
+# Request timeout of a single call, in seconds
+FANOUT_TIMEOUT = config.get('FANOUT_TIMEOUT', 10.0)
+# Seconds between two polls of the CA for revoked certificates, 0 disables
+# revocation checks
+REVOCATION_REFRESH_INTERVAL = config.get('REVOCATION_REFRESH_INTERVAL', 30.0)
+# Parsed peer certificates remembered by fingerprint, see PeerIdentities
+PEER_CACHE_SIZE = config.get('PEER_CACHE_SIZE', 1024)
+# Cipher suites of the server context, in order of preference: ECDHE key
+# exchange and AES-GCM or ChaCha20 are the cheapest to negotiate and run
+SERVER_CIPHERS = config.get('SERVER_CIPHERS',
+                            'ECDHE+AESGCM:ECDHE+CHACHA20:ECDHE+AES:'
+                            '!aNULL:!eNULL:!MD5:!DSS:!RC4:!3DES')
+SERVER_ECDH_CURVE = config.get('SERVER_ECDH_CURVE', 'prime256v1')
+# Let clients resume TLS sessions with tickets
+SERVER_SESSION_TICKETS = config.get('SERVER_SESSION_TICKETS', True)
+# Least time between two checks for a changed certificate, in seconds
+SERVER_RELOAD_INTERVAL = config.get('SERVER_RELOAD_INTERVAL', 5.0)
 
-if isDocker():
-    CA_HOSTNAME = "ca"
-    CA_PORT = 80
-    TOKEN_HOSTNAME = "reversests"
-    TOKEN_PORT = 80
-else:
-    CA_HOSTNAME = '0.0.0.0'
-    CA_PORT = 8080
-    TOKEN_HOSTNAME = '0.0.0.0'
-    TOKEN_PORT = 8083
 
-CA_URL = 'https://%s:%s/' % (CA_HOSTNAME, CA_PORT)
-TOKEN_URL = 'http://%s:%s/' % (TOKEN_HOSTNAME, TOKEN_PORT)
+class Endpoints():
+    """Addresses of the infrastructure services.
 
+    In a container the CA and the token service are reached by their
+    names on port 80, otherwise on the local host. CA_HOSTNAME, CA_PORT,
+    TOKEN_HOSTNAME and TOKEN_PORT override either. CA_INSTANCES lists the
+    base URLs of the CA instances that sign CSRs, comma separated, by
+    default the root CA. Intermediate instances share the load;
+    certificates are verified up to the root certificate all the same.
+    """
+    def __init__(self, config):
+        if config.isDocker():
+            caHostname, caPort = 'ca', 80
+            tokenHostname, tokenPort = 'reversests', 80
+        else:
+            caHostname, caPort = '0.0.0.0', 8080
+            tokenHostname, tokenPort = '0.0.0.0', 8081
+        self.caHostname = config.get('CA_HOSTNAME', caHostname)
+        self.caPort = config.get('CA_PORT', caPort)
+        self.tokenHostname = config.get('TOKEN_HOSTNAME', tokenHostname)
+        self.tokenPort = config.get('TOKEN_PORT', tokenPort)
+        self.caUrl = 'https://%s:%s/' % (self.caHostname, self.caPort)
+        self.tokenUrl = 'http://%s:%s/' % (self.tokenHostname, self.tokenPort)
+        self.caInstances = [url.rstrip('/') + '/'
+                            for url in config.get('CA_INSTANCES', [])] \
+                           or [self.caUrl]
+
+
+# Resolved on first use, see getEndpoints()
+endpoints = None
+endpointsLock = threading.Lock()
+
+
+def getEndpoints():
+    global endpoints
+    with endpointsLock:
+        if endpoints is None:
+            endpoints = Endpoints(config)
+        return endpoints
+
+tokenValidations = metrics.counter('missfire_token_validations_total',
+                                   "Inbound tokens checked, by result",
+                                   ['result'])
+jwtVerifyLatency = metrics.histogram('missfire_jwt_verify_seconds',
+                                     "Time to verify a JWT signature, "
+                                     "in seconds")
+outboundLatency = metrics.histogram('missfire_outbound_seconds',
+                                    "Time of outbound calls, in seconds",
+                                    ['method', 'host'])
+outboundErrors = metrics.counter('missfire_outbound_errors_total',
+                                 "Outbound calls that got no response",
+                                 ['method', 'host'])
+
+
+
+class BootstrapTimer():
+    """Records how long each phase of the service bootstrap takes."""
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - start))
+
+    def report(self, logger):
+        if not self.phases:
+            return
+        total = sum(duration for _, duration in self.phases)
+        summary = ', '.join('%s=%.3fs' % p for p in self.phases)
+        logger.info("Bootstrap took %.3fs: %s" % (total, summary))
+
+
+bootstrapTimer = BootstrapTimer()
+
+
+def retry(func, attempts=BOOTSTRAP_RETRIES, backoff=BOOTSTRAP_BACKOFF,
+          maxBackoff=BOOTSTRAP_MAX_BACKOFF):
+    """Call func until it returns a true value, with exponential backoff.
+
+    Returns the last result, i.e. a false value if all attempts failed.
+    """
+    res = False
+    for attempt in range(attempts):
+        res = func()
+        if res:
+            break
+        if attempt < attempts - 1:
+            time.sleep(min(backoff * 2 ** attempt, maxBackoff))
+    return res
+
+
+
+def generateKey(keyType='rsa'):
+    """Generate a private key: RSA 2048 or ECDSA P-256."""
+    if keyType == 'ec':
+        return ec.generate_private_key(ec.SECP256R1(), default_backend())
+    elif keyType == 'rsa':
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                        backend=default_backend())
+    raise ValueError("Unsupported key type: %s" % keyType)
+
+
+class KeyPool():
+    """Pre-generated private keys for fast service certificate issuance.
+
+    Keys are taken from memory first, then from the on-disk cache directory
+    and are generated on the spot only when both are empty. A background
+    thread keeps 'size' keys in memory and 'cacheSize' keys in the disk
+    cache, so the next start of the container does not wait for key
+    generation either.
+    """
+    def __init__(self, logger, keyType='rsa', size=0, cacheDir=None,
+                 cacheSize=KEY_CACHE_SIZE):
+        self.logger = logger
+        self.keyType = keyType
+        self.size = size
+        self.cacheDir = cacheDir
+        self.cacheSize = cacheSize if cacheDir else 0
+        self.keys = Queue.Queue(maxsize=max(size, 1))
+        self.taken = threading.Event() # A key was taken from the disk cache
+        self.thread = None
+        if self.cacheDir and not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+    def start(self):
+        """Start refilling the pool in the background."""
+        if (self.size > 0 or self.cacheSize > 0) and self.thread is None:
+            self.thread = threading.Thread(target=self._fill,
+                                           name='KeyPool')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _fill(self):
+        while True:
+            try:
+                # Cleared before counting, so that no take goes unnoticed
+                self.taken.clear()
+                if self.cacheSize and self._cached() < self.cacheSize:
+                    self._store(generateKey(self.keyType))
+                elif self.size > 0:
+                    # Blocks while the in-memory pool is full
+                    self.keys.put(generateKey(self.keyType))
+                else:
+                    # The disk cache is full, wait until a key is taken
+                    self.taken.wait()
+            except Exception as e:
+                self.logger.error("Key pool refill failed: %s" % e)
+                time.sleep(1)
+
+    def _cached(self):
+        return len([f for f in os.listdir(self.cacheDir)
+                    if f.startswith(self.keyType + '-') and f.endswith('.pem')])
+
+    def _store(self, key):
+        name = os.path.join(self.cacheDir,
+                            '%s-%s.pem' % (self.keyType, uuid.uuid4()))
+        with open(name + '.tmp', 'wb') as f:
+            f.write(serializeKey(key))
+        os.rename(name + '.tmp', name)
+
+    def _takeCached(self):
+        """Claim one key file from the cache directory."""
+        for f in sorted(os.listdir(self.cacheDir)):
+            if not (f.startswith(self.keyType + '-') and f.endswith('.pem')):
+                continue
+            path = os.path.join(self.cacheDir, f)
+            claimed = path + '.%d' % os.getpid()
+            try:
+                # Only one process wins the rename of a given file
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            with open(claimed, 'rb') as key:
+                data = key.read()
+            os.remove(claimed)
+            self.taken.set()
+            return serialization.load_pem_private_key(data, None,
+                                                      default_backend())
+
+    def take(self):
+        """Return a fresh private key, as fast as possible."""
+        try:
+            return self.keys.get_nowait()
+        except Queue.Empty:
+            pass
+        if self.cacheDir:
+            key = self._takeCached()
+            if key is not None:
+                return key
+        return generateKey(self.keyType)
+
+
+def serializeKey(key):
+    """Unencrypted PEM form of a private key, like 'openssl req -nodes'."""
+    return key.private_bytes(encoding=serialization.Encoding.PEM,
+                             format=serialization.PrivateFormat.PKCS8,
+                             encryption_algorithm=serialization.NoEncryption())
+
+
+def readAltNames(sslConfigFile):
+    """DNS names from the [ alternate_names ] section of an OpenSSL config."""
+    names = []
+    section = None
+    with open(sslConfigFile, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            match = re.match(r'^\[\s*(\S+)\s*\]$', line)
+            if match:
+                section = match.group(1)
+            elif section == 'alternate_names' and line.startswith('DNS.'):
+                names.append(line.split('=', 1)[1].strip())
+    return names
+
+
+PEM_CERT_END = '-----END CERTIFICATE-----'
+
+
+def splitPem(pemData):
+    """The PEM blocks of the certificates in pemData, in order."""
+    return [block.strip() + '\n' + PEM_CERT_END + '\n'
+            for block in pemData.split(PEM_CERT_END) if block.strip()]
+
+
+def isSignedBy(cert, issuer):
+    """True if issuer's key made the signature of cert."""
+    if cert.issuer != issuer.subject:
+        return False
+    pubKey = issuer.public_key()
+    try:
+        if isinstance(pubKey, rsa.RSAPublicKey):
+            pubKey.verify(cert.signature, cert.tbs_certificate_bytes,
+                          padding.PKCS1v15(), cert.signature_hash_algorithm)
+        elif isinstance(pubKey, ec.EllipticCurvePublicKey):
+            pubKey.verify(cert.signature, cert.tbs_certificate_bytes,
+                          ec.ECDSA(cert.signature_hash_algorithm))
+        else:
+            return False
+    except InvalidSignature:
+        return False
+    return True
+
+
+def isCA(cert):
+    try:
+        return cert.extensions.get_extension_for_class(
+            x509.BasicConstraints).value.ca
+    except x509.ExtensionNotFound:
+        return False
+
+
+def verifyChain(pemData, caCertFile):
+    """True if the first certificate in pemData chains to the CA certificate.
+
+    The certificates that follow are intermediate CAs, each signed by the
+    next one and the last one by the CA of caCertFile. None may be expired.
+    """
+    backend = default_backend()
+    certs = [load_pem_x509_certificate(block.encode('ascii'), backend)
+             for block in splitPem(pemData)]
+    with open(caCertFile, 'rb') as f:
+        caCert = load_pem_x509_certificate(f.read(), backend)
+    if certs and certs[-1] == caCert:
+        certs.pop()
+    if not certs:
+        return False
+    now = datetime.datetime.utcnow()
+    issuers = certs[1:] + [caCert]
+    for cert, issuer in zip(certs, issuers):
+        if not isSignedBy(cert, issuer) or cert.not_valid_after < now:
+            return False
+    return all(isCA(issuer) for issuer in issuers[:-1])
 
 
 class ServiceCert():
@@ -43,74 +413,447 @@ class ServiceCert():
     How to use MTLS in Flask:
     https://stackoverflow.com/questions/28579142/attributeerror-context-object-has-no-attribute-wrap-socket#28590266
     """
-    def __init__(self, logger, serviceType='notype', debug=False):
+    def __init__(self, logger, serviceType='notype', debug=False,
+                 keyType=None, keyPool=None, bootstrap=True):
         self.logger = logger
         self.serviceType = serviceType
         self.debug = debug
+        self.keyType = keyType # None -- use the openssl tool
+        self.keyPool = keyPool
         self.sslConfigFile = 'openssl-service.cnf' # Basic service config.
         self.serviceKeyFile = 'servicekey.key' # Private key
         self.serviceCSRFile = 'servicecert.csr' # Service certificate request
         self.serviceCertFile = 'servicecert.pem' # Service certificate
         self.caCert = 'cacert.pem' # CA certificate
-        
+        self.lockFile = '.servicecert.lock' # Held while the above change
+
+        # Certificate and key currently in use, see renew()
+        self.currentCertFile = self.serviceCertFile
+        self.currentKeyFile = self.serviceKeyFile
+        self.generation = 0
+        self.renewalListeners = []
+        self.renewalThread = None
+        self.renewals = 0
+        self.renewalFailures = 0
+        self.lastRenewalLatency = None
+        # Fetched to check a reused certificate, see reuse()
+        self.revocations = None
+
+        if bootstrap:
+            self.bootstrap()
+
+    def bootstrap(self):
+        """Obtain a signed service certificate, blocking until done.
+
+        Processes of the service take turns, see _locked(): the first one
+        issues the certificate, the others reuse it.
+        """
         if self.debug:
-            while(not self.UNSAFE_getCAcert()): time.sleep(2)
-        if self.genCSR():
-            self.signCSR()
-        
-    def signCSR(self):
-        """Submit an existing CSR to CA for signing."""
+            with bootstrapTimer.phase('ca_cert'):
+                while(not self.UNSAFE_getCAcert()): time.sleep(2)
+        with self._locked():
+            cached = self.findCached()
+            if cached and self._timed('reuse', self.reuse, *cached):
+                return
+            with bootstrapTimer.phase('csr'):
+                isGenerated = self.genCSR()
+            if isGenerated:
+                with bootstrapTimer.phase('sign'):
+                    if self.signCSR():
+                        self.saveToCache()
+
+    def bootstrapConcurrently(self, executor):
+        """Obtain a signed service certificate with bounded retries.
+
+        The CA certificate is fetched on the executor while the key and CSR
+        are generated in the calling thread. Returns True on success.
+        """
+        caFetched = None
+        if self.debug:
+            caFetched = executor.submit(self._timed, 'ca_cert',
+                                        retry, self.UNSAFE_getCAcert)
+        with self._locked():
+            cached = self.findCached()
+            if cached:
+                # The chain is verified once the CA certificate is in place
+                if caFetched and not caFetched.result():
+                    self.logger.error("CA certificate not retrieved")
+                    return False
+                if self._timed('reuse', self.reuse, *cached):
+                    return True
+            isGenerated = self._timed('csr', self.genCSR)
+            if caFetched and not caFetched.result():
+                self.logger.error("CA certificate not retrieved")
+                return False
+            if not isGenerated:
+                return False
+            if not self._timed('sign', retry, self.signCSR):
+                return False
+            self.saveToCache()
+            return True
+
+    @contextmanager
+    def _locked(self):
+        """Hold the certificate files of the service directory.
+
+        Gunicorn workers bootstrap after the fork, all in the same
+        directory. The lock keeps them from writing servicekey.key and
+        servicecert.pem at the same time.
+        """
+        with open(self.lockFile, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def _timed(name, func, *args):
+        with bootstrapTimer.phase(name):
+            return func(*args)
+
+    def findCached(self):
+        """Certificate and key files of a previous run worth reusing.
+
+        Returns the first pair, in the service directory or in
+        CERT_CACHE_DIR, that belongs together, was issued to this service
+        type and has more than CERT_MIN_VALIDITY left; None otherwise.
+        Whether it chains to the CA certificate is checked by reuse().
+        """
+        if not CERT_REUSE:
+            return None
+        for directory in filter(None, ['.', CERT_CACHE_DIR]):
+            certFile = os.path.join(directory, self.serviceCertFile)
+            keyFile = os.path.join(directory, self.serviceKeyFile)
+            if os.path.isfile(certFile) and os.path.isfile(keyFile) and \
+               self.isReusable(certFile, keyFile):
+                return certFile, keyFile
+        return None
+
+    def isReusable(self, certFile, keyFile):
+        backend = default_backend()
+        try:
+            cert = self.loadCert(certFile)
+            with open(keyFile, 'rb') as f:
+                key = serialization.load_pem_private_key(f.read(), None,
+                                                         backend)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.warning("%s not reusable: %s" % (certFile, e))
+            return False
+        if cert.public_key().public_numbers() != \
+           key.public_key().public_numbers():
+            self.logger.warning("%s does not match %s" % (certFile, keyFile))
+            return False
+        if PeerIdentity(cert, None).serviceType != self.serviceType:
+            return False
+        timeLeft = (cert.not_valid_after -
+                    datetime.datetime.utcnow()).total_seconds()
+        return timeLeft > CERT_MIN_VALIDITY
+
+    def reuse(self, certFile, keyFile):
+        """Use a certificate of a previous run, True if it is valid.
+
+        The chain must verify against the CA certificate, and the serial
+        number must not be revoked as far as the CA can tell right now.
+        Without an answer from the CA a new certificate is issued instead.
+        """
+        with open(certFile, 'r') as f:
+            pemData = f.read()
+        if not os.path.exists(self.caCert) or \
+           not verifyChain(pemData, self.caCert):
+            self.logger.warning("%s does not chain to %s, not reused"
+                                % (certFile, self.caCert))
+            return False
+        cert = self.loadCert(certFile)
+        if REVOCATION_REFRESH_INTERVAL > 0:
+            revocations = RevocationList(self.logger, self.caCert)
+            revocations.refresh()
+            if revocations.lastRefresh is None:
+                self.logger.warning("Revocations unknown, %s not reused"
+                                    % certFile)
+                return False
+            if revocations.isRevoked(cert.serial_number):
+                self.logger.warning("%s is revoked, not reused" % certFile)
+                return False
+            self.revocations = revocations
+        if os.path.dirname(certFile) != '.':
+            self._publish(keyFile, self.serviceKeyFile, 0o600)
+            self._publish(certFile, self.serviceCertFile)
+        timeLeft = cert.not_valid_after - datetime.datetime.utcnow()
+        self.logger.info("Service certificate %X reused, valid for %s"
+                         % (cert.serial_number, timeLeft))
+        return True
+
+    def saveToCache(self):
+        """Copy the certificate and key in use to CERT_CACHE_DIR."""
+        if not CERT_CACHE_DIR:
+            return
+        try:
+            if not os.path.isdir(CERT_CACHE_DIR):
+                os.makedirs(CERT_CACHE_DIR)
+            self._publish(self.currentKeyFile,
+                          os.path.join(CERT_CACHE_DIR, self.serviceKeyFile),
+                          0o600)
+            self._publish(self.currentCertFile,
+                          os.path.join(CERT_CACHE_DIR, self.serviceCertFile))
+        except (IOError, OSError) as e:
+            self.logger.warning("Certificate not cached: %s" % e)
+
+    def signCSR(self, csrFile=None, certFile=None):
+        """Submit an existing CSR to CA for signing.
+
+        The CA instances are tried in random order, which spreads the load
+        and skips instances that are down.
+        """
+        csrFile = csrFile or self.serviceCSRFile
+        certFile = certFile or self.serviceCertFile
         res = False
-        if os.path.isfile(self.serviceCSRFile):
-            with open(self.serviceCSRFile,'r') as f:
+        if os.path.isfile(csrFile):
+            with open(csrFile,'r') as f:
                 csrData = f.read()
-            try:
-                url = CA_URL + 'ca/sign'
-                payload = {'token': 'secret', 
-                           'serviceType': self.serviceType,
-                           'csr': csrData}
-                if os.path.exists(self.caCert):
-                    res = requests.post(url, json=payload, verify=self.caCert)
-                else:
-                    msg = "No CA cert found, proceeding w/o verification"
-                    logger.error(msg)
-                    res = requests.post(url, json=payload, verify=False)
-            except requests.exceptions.ConnectionError as e:
-                self.logger.error("The CA service is unavailable.%s" % e)
-                return res
-
-            if res.status_code != requests.codes.ok:
-                self.logger.error("Cannot get certificate signed, resp %s, status code %s" \
-                               % (res.text, res.status_code))
-            else:
-                # Save PEM received from a CA
-                with open(self.serviceCertFile,'w') as f:
-                    f.write(res.json()['PEM'])
-                res = True
+            instances = getEndpoints().caInstances
+            instances = random.sample(instances, len(instances))
+            for caUrl in instances:
+                res = self.signCSRAt(caUrl, csrData, certFile)
+                if res:
+                    break
         else:
             self.logger.error("No CSR file found")
         return res
 
-    def genCSR(self):
+    def signCSRAt(self, caUrl, csrData, certFile):
+        """Have the CA instance at caUrl sign a CSR, True on success.
+
+        The certificate received, with the intermediates of the instance,
+        must chain to the CA certificate.
+        """
+        try:
+            url = caUrl + 'ca/sign'
+            payload = {'token': 'secret', 
+                       'serviceType': self.serviceType,
+                       'csr': csrData}
+            if os.path.exists(self.caCert):
+                res = requests.post(url, json=payload, verify=self.caCert)
+            else:
+                msg = "No CA cert found, proceeding w/o verification"
+                logger.error(msg)
+                res = requests.post(url, json=payload, verify=False)
+        except requests.exceptions.ConnectionError as e:
+            self.logger.error("The CA service is unavailable.%s" % e)
+            return False
+
+        if res.status_code != requests.codes.ok:
+            self.logger.error("Cannot get certificate signed, resp %s, status code %s" \
+                           % (res.text, res.status_code))
+            return False
+        pemData = res.json()['PEM']
+        if os.path.exists(self.caCert) and \
+           not verifyChain(pemData, self.caCert):
+            self.logger.error("Certificate signed by %s does not chain to %s"
+                              % (caUrl, self.caCert))
+            return False
+        # Save PEM received from a CA
+        with open(certFile,'w') as f:
+            f.write(pemData)
+        return True
+
+    def genCSR(self, keyFile=None, csrFile=None):
         """Create a service certificate request."""
+        keyFile = keyFile or self.serviceKeyFile
+        csrFile = csrFile or self.serviceCSRFile
+        if self.keyType:
+            return self.genCSRInProcess(keyFile, csrFile)
         res = False
         if os.path.exists(self.sslConfigFile):
             name = self.serviceType + '-' + str(uuid.uuid4())
             info = "/C=NO/ST=Hordaland/L=Bergen/O=UiB/CN=%s" % name
             os.system("openssl req -new -config %s -subj %s -nodes -keyout %s -out %s" \
-                   % (self.sslConfigFile, info, self.serviceKeyFile, self.serviceCSRFile))
+                   % (self.sslConfigFile, info, keyFile, csrFile))
             return True
         else:
             self.logger.error("OpenSSL service configuration file not found")
         return res
 
+    def genCSRInProcess(self, keyFile, csrFile):
+        """Create a service key and certificate request with cryptography.
+
+        Equivalent to genCSR with openssl-service.cnf, but without forking
+        openssl. The key is taken from the key pool when there is one.
+        """
+        if not os.path.exists(self.sslConfigFile):
+            self.logger.error("OpenSSL service configuration file not found")
+            return False
+        if self.keyPool:
+            key = self.keyPool.take()
+        else:
+            key = generateKey(self.keyType)
+        name = self.serviceType + '-' + str(uuid.uuid4())
+        subject = x509.Name([
+            x509.NameAttribute(NameOID.COUNTRY_NAME, u'NO'),
+            x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, u'Hordaland'),
+            x509.NameAttribute(NameOID.LOCALITY_NAME, u'Bergen'),
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, u'UiB'),
+            x509.NameAttribute(NameOID.COMMON_NAME, unicode(name)),
+        ])
+        altNames = [x509.DNSName(unicode(n))
+                    for n in readAltNames(self.sslConfigFile)]
+        # [ service_req_extensions ] section of openssl-service.cnf
+        builder = x509.CertificateSigningRequestBuilder() \
+            .subject_name(subject) \
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(
+                key.public_key()), critical=False) \
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None),
+                           critical=False) \
+            .add_extension(x509.KeyUsage(digital_signature=True,
+                content_commitment=False, key_encipherment=True,
+                data_encipherment=False, key_agreement=False,
+                key_cert_sign=False, crl_sign=False, encipher_only=False,
+                decipher_only=False), critical=False)
+        if altNames:
+            builder = builder.add_extension(
+                x509.SubjectAlternativeName(altNames), critical=False)
+        csr = builder.sign(key, hashes.SHA256(), default_backend())
+
+        with open(keyFile, 'wb') as f:
+            f.write(serializeKey(key))
+        with open(csrFile, 'wb') as f:
+            f.write(csr.public_bytes(serialization.Encoding.PEM))
+        return True
+
+    def loadCert(self, certFile=None):
+        """Parse the service certificate, None if there is none."""
+        certFile = certFile or self.currentCertFile
+        if os.path.isfile(certFile):
+            with open(certFile, 'rb') as f:
+                return load_pem_x509_certificate(f.read(), default_backend())
+
+    def addRenewalListener(self, listener):
+        """Call listener(certFile, keyFile) whenever the certificate is renewed."""
+        self.renewalListeners.append(listener)
+
+    def watchSSLContext(self, context):
+        """Load every renewed certificate into a server ssl.SSLContext.
+
+        load_cert_chain() affects new handshakes only, connections that are
+        already established keep working.
+        """
+        self.addRenewalListener(context.load_cert_chain)
+
+    def startRenewal(self):
+        """Start renewing the certificate in a background thread."""
+        if self.renewalThread is None:
+            self.renewalThread = threading.Thread(target=self._renewalLoop,
+                                                  name='CertRenewal')
+            self.renewalThread.daemon = True
+            self.renewalThread.start()
+
+    def _renewalLoop(self):
+        failures = 0
+        while True:
+            try:
+                time.sleep(self.nextRenewalDelay(failures))
+                isRenewed = self.renew()
+            except Exception as e:
+                self.logger.error("Certificate renewal failed: %s" % e)
+                isRenewed = False
+            failures = 0 if isRenewed else failures + 1
+
+    def nextRenewalDelay(self, failures=0):
+        """Seconds until the next renewal attempt.
+
+        A certificate is renewed after CERT_RENEW_AT of its lifetime, moved
+        by a random jitter so that services started together do not all
+        hit the CA at once. Failed attempts are retried with exponential
+        backoff, up to BOOTSTRAP_MAX_BACKOFF; while the certificate is
+        valid, always well before it expires.
+        """
+        cert = self.loadCert()
+        backoff = min(BOOTSTRAP_BACKOFF * 2 ** min(failures, 30),
+                      BOOTSTRAP_MAX_BACKOFF)
+        if cert is None:
+            return backoff
+        now = datetime.datetime.utcnow()
+        remaining = (cert.not_valid_after - now).total_seconds()
+        if failures:
+            if remaining <= 0:
+                # Expired: a hurried retry does not help, spare the CA
+                return backoff
+            return max(1, min(backoff, remaining / 2))
+        lifetime = (cert.not_valid_after - cert.not_valid_before).total_seconds()
+        fraction = CERT_RENEW_AT + random.uniform(-CERT_RENEW_JITTER,
+                                                  CERT_RENEW_JITTER)
+        renewAt = cert.not_valid_before + \
+                  datetime.timedelta(seconds=lifetime * fraction)
+        return max(0, (renewAt - now).total_seconds())
+
+    def renew(self):
+        """Re-key and re-sign the service certificate.
+
+        The new key and certificate are written under new file names, so
+        connections that are being set up with the previous pair are not
+        affected. Listeners switch over to the new pair, after which it is
+        also copied over servicecert.pem and servicekey.key. The workers of
+        the service renew in turn, see _locked().
+        """
+        start = time.time()
+        with self._locked():
+            generation = self.generation + 1
+            keyFile = 'servicekey.%d.key' % generation
+            csrFile = 'servicecert.%d.csr' % generation
+            certFile = 'servicecert.%d.pem' % generation
+            if not self.genCSR(keyFile, csrFile) or \
+               self.signCSR(csrFile, certFile) is not True:
+                self.renewalFailures += 1
+                self.logger.error("Certificate renewal failed")
+                return False
+
+            self.generation = generation
+            self.currentCertFile, self.currentKeyFile = certFile, keyFile
+            for listener in self.renewalListeners:
+                try:
+                    listener(certFile, keyFile)
+                except Exception as e:
+                    self.logger.error("Certificate renewal listener failed: %s" % e)
+            self._publish(keyFile, self.serviceKeyFile)
+            self._publish(certFile, self.serviceCertFile)
+            self.saveToCache()
+            # The previous generation may still be in use by a handshake
+            for f in ('servicekey.%d.key', 'servicecert.%d.csr',
+                      'servicecert.%d.pem'):
+                if os.path.isfile(f % (generation - 2)):
+                    os.remove(f % (generation - 2))
+
+        self.renewals += 1
+        self.lastRenewalLatency = time.time() - start
+        self.logger.info("Service certificate renewed in %.3fs"
+                         % self.lastRenewalLatency)
+        return True
+
+    @staticmethod
+    def _publish(src, dst, mode=None):
+        """Atomically replace dst with a copy of src."""
+        shutil.copyfile(src, dst + '.tmp')
+        if mode is not None:
+            os.chmod(dst + '.tmp', mode)
+        os.rename(dst + '.tmp', dst)
+
+    def renewalStats(self):
+        """Time to expiry and renewal figures of the service certificate."""
+        cert = self.loadCert()
+        secondsToExpiry = None
+        if cert is not None:
+            secondsToExpiry = (cert.not_valid_after -
+                               datetime.datetime.utcnow()).total_seconds()
+        return {'secondsToExpiry': secondsToExpiry,
+                'renewals': self.renewals,
+                'renewalFailures': self.renewalFailures,
+                'lastRenewalLatency': self.lastRenewalLatency}
+
     def UNSAFE_getCAcert(self):
         """Fetch the CA certificate, this is insecure."""
         res = False
         if self.debug:
             self.logger.warning("UNSAFE: Retrieving remote CA certificate")
+            ca = getEndpoints()
             try:
-                pemCert = ssl.get_server_certificate((CA_HOSTNAME, CA_PORT))
+                pemCert = ssl.get_server_certificate((ca.caHostname, ca.caPort))
             except socket_error as e:
                 self.logger.error("Socket error: %s" %e)
                 return res
@@ -150,56 +893,501 @@ class ServiceCert():
 
 
 
+class RevocationList():
+    """Serial numbers of revoked certificates, kept in memory.
+
+    A background thread polls the delta feed of the CA and adds the serials
+    revoked since the previous poll to a set. Checking a peer certificate
+    is a set lookup, with no network call per connection.
+
+    Every CA instance revokes the certificates it issued; their serial
+    numbers do not overlap, so the feeds of all instances share the set.
+    """
+    def __init__(self, logger, caCertFile,
+                 interval=REVOCATION_REFRESH_INTERVAL, urls=None):
+        self.logger = logger
+        self.caCertFile = caCertFile
+        self.interval = interval
+        if not urls:
+            ca = getEndpoints()
+            urls = set([ca.caUrl] + ca.caInstances)
+        self.urls = sorted(urls)
+        self.serials = set()
+        self.last = {} # Number of the latest revocation known, per CA
+        self.lastRefresh = None
+        self.thread = None
+
+    def start(self):
+        """Start refreshing the list in a background thread."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._refreshLoop,
+                                           name='RevocationList')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _refreshLoop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.warning("Revocation list not refreshed: %s" % e)
+            time.sleep(self.interval)
+
+    def refresh(self):
+        """Fetch the revocations newer than the latest one known."""
+        revoked = []
+        fetched = False
+        for url in self.urls:
+            try:
+                revoked.extend(self.refreshFrom(url))
+                fetched = True
+            except Exception as e:
+                self.logger.warning("Revocations of %s not fetched: %s"
+                                    % (url, e))
+        if fetched:
+            self.lastRefresh = time.time()
+        if revoked:
+            self.logger.warning("Certificates revoked: %s"
+                                % ', '.join('%X' % s for s in revoked))
+        return revoked
+
+    def refreshFrom(self, url):
+        res = requests.get(url + 'ca/revoked',
+                           params={'since': self.last.get(url, 0)},
+                           verify=self.caCertFile, timeout=10)
+        res.raise_for_status()
+        feed = res.json()
+        revoked = [int(r['serial'], 16) for r in feed['revoked']]
+        self.serials.update(revoked)
+        self.last[url] = feed['last']
+        return revoked
+
+    def isRevoked(self, serial):
+        return serial in self.serials
+
+
+
+class ServerSSLContext():
+    """Server side ssl.SSLContext for MTLS, reloaded when the files change.
+
+    Requires client certificates signed by the CA, picks the cipher by the
+    server's order of SERVER_CIPHERS, uses SERVER_ECDH_CURVE for key
+    exchange, announces 'http/1.1' with ALPN and keeps session tickets and
+    the session cache on, so returning clients skip the full handshake.
+
+    The certificate and key are loaded into the same context when they
+    change on disk, which keeps its session ticket keys. Created before
+    gunicorn forks, e.g. at import with preload_app, the context is
+    shared by all workers and a ticket issued by one worker is accepted by
+    the others. See useInGunicorn().
+    """
+    def __init__(self, certFile, keyFile, caCertFile,
+                 reloadInterval=SERVER_RELOAD_INTERVAL):
+        self.certFile = certFile
+        self.keyFile = keyFile
+        self.caCertFile = caCertFile
+        self.reloadInterval = reloadInterval
+        self.lock = threading.Lock()
+        self.checked = time.time()
+        self.reloads = 0
+        self.context = self.create()
+
+    def create(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | \
+                           ssl.OP_NO_COMPRESSION | \
+                           ssl.OP_CIPHER_SERVER_PREFERENCE | \
+                           ssl.OP_SINGLE_ECDH_USE
+        if not SERVER_SESSION_TICKETS:
+            # SSL_OP_NO_TICKET, not exported by the ssl module of Python 2
+            context.options |= getattr(ssl, 'OP_NO_TICKET', 0x4000)
+        context.set_ciphers(SERVER_CIPHERS)
+        context.set_ecdh_curve(SERVER_ECDH_CURVE)
+        if ssl.HAS_ALPN:
+            context.set_alpn_protocols(['http/1.1'])
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(self.caCertFile)
+        context.load_cert_chain(self.certFile, self.keyFile)
+        self.mtimes = self._mtimes()
+        return context
+
+    def _mtimes(self):
+        return (os.stat(self.certFile).st_mtime, os.stat(self.keyFile).st_mtime)
+
+    def isPair(self, certFile, keyFile):
+        """Check that the key belongs to the certificate.
+
+        The files are replaced one after the other; loading a certificate
+        with the key of another one would break every new handshake.
+        """
+        with open(certFile, 'rb') as f:
+            cert = load_pem_x509_certificate(f.read(), default_backend())
+        with open(keyFile, 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), None,
+                                                     default_backend())
+        return cert.public_key().public_numbers() == \
+               key.public_key().public_numbers()
+
+    def load(self, certFile=None, keyFile=None):
+        """Load a certificate and key in place, for new handshakes."""
+        certFile = certFile or self.certFile
+        keyFile = keyFile or self.keyFile
+        with self.lock:
+            if not self.isPair(certFile, keyFile):
+                return False
+            self.context.load_cert_chain(certFile, keyFile)
+            self.mtimes = self._mtimes()
+            self.reloads += 1
+        logger.info("Server certificate reloaded from %s" % certFile)
+        return True
+
+    def checkReload(self):
+        """Reload the files if they changed, at most every reloadInterval."""
+        now = time.time()
+        if now - self.checked < self.reloadInterval:
+            return
+        self.checked = now
+        try:
+            if self._mtimes() != self.mtimes:
+                self.load()
+        except (IOError, OSError, ValueError, ssl.SSLError) as e:
+            logger.warning("Server certificate not reloaded: %s" % e)
+
+    def wrap_socket(self, sock, do_handshake_on_connect=True,
+                    suppress_ragged_eofs=True):
+        """Wrap an accepted connection, like ssl.SSLContext.wrap_socket."""
+        self.checkReload()
+        return self.context.wrap_socket(
+            sock, server_side=True,
+            do_handshake_on_connect=do_handshake_on_connect,
+            suppress_ragged_eofs=suppress_ragged_eofs)
+
+
+class GunicornSSL():
+    """Stands in for the ssl module in gunicorn's workers.
+
+    Gunicorn 19 calls ssl.wrap_socket() with its certfile, keyfile, etc.
+    settings for every connection, which builds a new SSLContext each
+    time. Here connections are wrapped by a shared ServerSSLContext
+    instead; everything else is the ssl module.
+    """
+    def __init__(self, serverContext):
+        self.serverContext = serverContext
+
+    def __getattr__(self, name):
+        return getattr(ssl, name)
+
+    def wrap_socket(self, sock, do_handshake_on_connect=True,
+                    suppress_ragged_eofs=True, **settings):
+        return self.serverContext.wrap_socket(sock, do_handshake_on_connect,
+                                              suppress_ragged_eofs)
+
+
+def useInGunicorn(serverContext):
+    """Serve gunicorn's sync and gthread workers with serverContext.
+
+    Call it from the gunicorn config file or at import of the app, with
+    preload_app. Gunicorn still needs certfile and keyfile so that it
+    treats the connections as TLS.
+    """
+    from gunicorn.workers import sync, gthread
+    sync.ssl = gthread.ssl = GunicornSSL(serverContext)
+
+
+
+# CN of service certificates, serviceType-uuid4, see ServiceCert.genCSR()
+SERVICE_CN = re.compile(r'^(.+)-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}'
+                        r'-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+
+class PeerIdentity():
+    """Identity of a calling service, from its MTLS certificate."""
+    def __init__(self, cert, fingerprint):
+        self.fingerprint = fingerprint
+        self.serial = cert.serial_number
+        names = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+        self.commonName = names[0].value if names else ''
+        match = SERVICE_CN.match(self.commonName)
+        self.serviceType = match.group(1) if match else self.commonName
+
+
+class PeerIdentities():
+    """Peer identities by SHA-256 fingerprint of the DER certificate.
+
+    Repeat callers present the same certificate, so identifying them costs
+    a hash and a dict lookup instead of parsing X.509.
+    """
+    def __init__(self, maxSize=PEER_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.identities = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, der):
+        fingerprint = hashlib.sha256(der).hexdigest()
+        with self.lock:
+            identity = self.identities.pop(fingerprint, None)
+            if identity is not None:
+                self.identities[fingerprint] = identity
+                self.hits += 1
+                return identity
+            self.misses += 1
+        cert = x509.load_der_x509_certificate(der, default_backend())
+        identity = PeerIdentity(cert, fingerprint)
+        with self.lock:
+            self.identities[fingerprint] = identity
+            while len(self.identities) > self.maxSize:
+                self.identities.popitem(last=False)
+        return identity
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.identities)}
+
+
+
+class TokenCache():
+    """Bounded LRU cache of verified tokens and their claims.
+
+    Entries are keyed by the SHA-256 digest of the token and expire after
+    'ttl' seconds, but never later than the 'exp' claim of the token.
+    """
+    def __init__(self, maxSize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(token):
+        if not isinstance(token, bytes):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).digest()
+
+    def get(self, token):
+        """Claims of a previously verified token, None if unknown or expired."""
+        key = self.key(token)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[1] > time.time():
+                # Re-insert as the most recently used entry
+                self.entries[key] = entry
+                self.hits += 1
+                return dict(entry[0])
+            self.misses += 1
+
+    def put(self, token, claims):
+        expiresAt = time.time() + self.ttl
+        if 'exp' in claims:
+            expiresAt = min(expiresAt, claims['exp'])
+        key = self.key(token)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (dict(claims), expiresAt)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.entries)}
+
+
+
+def b64urlToInt(value):
+    """Integer from its unpadded base64url form (RFC 7518)."""
+    value = str(value)
+    data = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+    return int(binascii.hexlify(data), 16)
+
+
+# JWK "crv" values to cryptography curves
+JWK_CURVES = {
+    'P-256': ec.SECP256R1,
+    'P-384': ec.SECP384R1,
+    'P-521': ec.SECP521R1,
+}
+
+
+def jwkToKey(jwk):
+    """Public key object of an RSA or EC JWK."""
+    if jwk['kty'] == 'RSA':
+        numbers = rsa.RSAPublicNumbers(b64urlToInt(jwk['e']),
+                                       b64urlToInt(jwk['n']))
+    elif jwk['kty'] == 'EC':
+        numbers = ec.EllipticCurvePublicNumbers(b64urlToInt(jwk['x']),
+                                                b64urlToInt(jwk['y']),
+                                                JWK_CURVES[jwk['crv']]())
+    else:
+        raise ValueError("Unsupported key type: %s" % jwk['kty'])
+    return numbers.public_key(default_backend())
+
+
+class KeyCache():
+    """Token verification keys by key ID, kept in memory.
+
+    The key set is fetched from the token service's /cert/jwks. A token
+    with an unknown 'kid' triggers a refresh, at most once per
+    'minInterval' seconds, so keys can be rotated without restarts.
+    Concurrent refreshes are collapsed into one request, and the key set
+    is revalidated by its ETag, so an unchanged one is not sent again.
+    Token services without /cert/jwks are served from /cert/pem.
+    """
+    def __init__(self, logger, minInterval=TOKEN_KEYS_REFRESH_INTERVAL):
+        self.logger = logger
+        self.minInterval = minInterval
+        self.keys = {} # kid -> (public key, algorithm), None -> current key
+        self.lock = threading.Lock()
+        self.inflight = None
+        self.isLoaded = False
+        self.lastRefresh = 0
+        self.etag = None
+        self.removedListeners = []
+
+    def get(self, kid, refresh=True):
+        """(public key, algorithm) for a key ID, None if unknown."""
+        key = self.keys.get(kid)
+        if key is None and refresh and \
+           time.time() - self.lastRefresh >= self.minInterval:
+            self.refresh()
+            key = self.keys.get(kid)
+        return key
+
+    def refresh(self):
+        """Fetch the key set; callers arriving meanwhile wait for that fetch."""
+        with self.lock:
+            inflight = self.inflight
+            isLeader = inflight is None
+            if isLeader:
+                inflight = self.inflight = threading.Event()
+        if not isLeader:
+            inflight.wait(BOOTSTRAP_WAIT)
+            return self.isLoaded
+        try:
+            keys = self._fetch()
+            if keys:
+                removed = set(self.keys) - set(keys)
+                self.keys = keys
+                self.isLoaded = True
+                if removed:
+                    for listener in self.removedListeners:
+                        listener(removed)
+        except Exception as e:
+            self.logger.error("Token verification keys not loaded: %s" % e)
+        finally:
+            self.lastRefresh = time.time()
+            with self.lock:
+                self.inflight = None
+            inflight.set()
+        return self.isLoaded
+
+    def _fetch(self):
+        """Fetch and parse the key set, this is insecure."""
+        try:
+            headers = {}
+            if self.etag and self.isLoaded:
+                headers['If-None-Match'] = self.etag
+            res = requests.get(getEndpoints().tokenUrl + 'cert/jwks',
+                               headers=headers)
+            if res.status_code == requests.codes.not_found:
+                return self._fetchPem()
+        except requests.exceptions.ConnectionError:
+            self.logger.error("The UserAuthToken service is unavailable.")
+            return
+        if res.status_code == requests.codes.not_modified:
+            return self.keys
+        if res.status_code != requests.codes.ok:
+            self.logger.error("Cannot get keys for token verification, resp %s, status code %s" \
+                              % (res.text, res.status_code))
+            return
+        keys = {}
+        for jwk in res.json().get('keys', []):
+            algorithm = jwk.get('alg', JWT_ALGORITHM)
+            if algorithm not in JWT_ALGORITHMS:
+                self.logger.error("JWT algorithm '%s' is not allowed" % algorithm)
+                continue
+            keys[jwk.get('kid')] = (jwkToKey(jwk), algorithm)
+            if None not in keys:
+                # The first key is the current one, used for tokens w/o kid
+                keys[None] = keys[jwk.get('kid')]
+        self.logger.info("UserAuthToken verification keys retrieved: %d"
+                         % len(res.json().get('keys', [])))
+        self.etag = res.headers.get('ETag')
+        return keys
+
+    def _fetchPem(self):
+        """Fallback for token services that only publish /cert/pem."""
+        res = requests.get(getEndpoints().tokenUrl + 'cert/pem')
+        if res.status_code != requests.codes.ok or not res.json()['PEM']:
+            self.logger.error("Cannot get a certificate for token verification, resp %s, status code %s" \
+                              % (res.text, res.status_code))
+            return
+        data = res.json()
+        algorithm = data.get('alg', JWT_ALGORITHM)
+        if algorithm not in JWT_ALGORITHMS:
+            self.logger.error("JWT algorithm '%s' is not allowed" % algorithm)
+            return
+        pem = data['PEM']
+        if not isinstance(pem, bytes):
+            pem = pem.encode('ascii')
+        pubKey = load_pem_x509_certificate(pem, default_backend()).public_key()
+        self.logger.info("UserAuthToken endpoint verif. cert. retrieved")
+        return {None: (pubKey, algorithm), data.get('kid'): (pubKey, algorithm)}
+
+
+
 class SecurityToken():
     """Manages user authentication tokens in JWT format.
 
     User authentication information propagates as a JWT through the network.
     """
-    def __init__(self, logger, debug=False):
+    def __init__(self, logger, debug=False, bootstrap=True):
         self.logger = logger
         self.debug = debug
-        self.tokenCert = 'tokencert.pem' # CA certificate
         self.latest = None
+        self.keys = KeyCache(logger)
+        self.cache = TokenCache() if TOKEN_CACHE_SIZE > 0 else None
+        if self.cache:
+            # Tokens signed with a withdrawn key must be verified again
+            self.keys.removedListeners.append(lambda kids: self.cache.clear())
+        if bootstrap:
+            self.bootstrap()
+
+    def bootstrap(self):
+        """Load the token verification keys, blocking until done."""
         if self.debug:
-            isLoaded = self.getCertRemote()
+            with bootstrapTimer.phase('token_cert'):
+                isLoaded = self.keys.refresh()
             if isLoaded:
-                self.pubKey = self.getPubKey()
-                self.validate(self.getTestToken())
+                with bootstrapTimer.phase('token_test'):
+                    self.validate(self.getTestToken())
             else:
                 self.logger.error("Remote certificate required. Terminating")
                 exit()
 
-    def getCertRemote(self):
-        """Fetch a certificate for token verification, this is insecure."""
-        res = False
-        try:
-            url = TOKEN_URL + 'cert/pem'
-            res = requests.get(url)#, verify=self.caCert)
-        except requests.exceptions.ConnectionError:
-            self.logger.error("The UserAuthToken service is unavailable.")
-            return res
-
-        if res.status_code != requests.codes.ok:
-            self.logger.error("Cannot get a certificate for token verification, resp %s, status code %s" \
-                           % (res.text, res.status_code))
-        else:
-            # Save PEM received from the UserAuthToken service
-            if res.json()['PEM']:
-                with open(self.tokenCert,'w') as f:
-                    f.write(res.json()['PEM'])
-                self.logger.info("UserAuthToken endpoint verif. cert. retrieved")
-                res = True
-        return res
+    def bootstrapConcurrently(self):
+        """Load the token verification keys with bounded retries.
 
-    def getPubKey(self):
-        """Retrieve a public key from the full certificate."""
-        if os.path.isfile(self.tokenCert):
-            with open(self.tokenCert,'r') as f:
-                certPEM = f.read()
-                certObj = load_pem_x509_certificate(certPEM, default_backend())
-                return certObj.public_key()
-        else:
-            self.logger.info("Public key cannot be loaded: file not found.")
+        Returns True when tokens can be validated.
+        """
+        if not self.debug:
+            return True
+        with bootstrapTimer.phase('token_cert'):
+            isLoaded = retry(self.keys.refresh)
+        if not isLoaded:
+            self.logger.error("Remote certificate for token verification "
+                              "not retrieved")
+            return False
+        with bootstrapTimer.phase('token_test'):
+            self.validate(retry(self.getTestToken))
+        return True
 
     def getTestToken(self):
         if self.debug:
@@ -211,7 +1399,7 @@ class SecurityToken():
 
     def getToken(self, username):
         try:
-            url = TOKEN_URL + 'login'
+            url = getEndpoints().tokenUrl + 'login'
             payload = {'username': username}
             res = requests.post(url, json=payload)#, verify=self.caCert)
         except requests.exceptions.ConnectionError:
@@ -225,26 +1413,101 @@ class SecurityToken():
             data_json = res.json()
             if 'access_token' in data_json:
                 accessToken = data_json['access_token']
-                self.logger.info("access_token: %s" % accessToken)
+                self.logger.info("access_token received for '%s'" % username)
                 return accessToken
             else:
                 self.logger.warning("No access token found, resp: %s" % data_json)
 
     def validate(self, token):
         if token:
-            if self.pubKey:
+            if self.keys.isLoaded:
+                if self.cache:
+                    token_decoded = self.cache.get(token)
+                    if token_decoded is not None:
+                        tokenValidations.inc(result='cached')
+                        self.latest = token
+                        return token_decoded
                 try:
-                    token_decoded = jwt.decode(token, self.pubKey, algorithms=['RS256'])
+                    kid = jwt.get_unverified_header(token).get('kid')
+                    key = self.keys.get(kid, refresh=self.debug)
+                    if key is None:
+                        raise jwt.InvalidTokenError("Unknown key ID '%s'" % kid)
+                    pubKey, algorithm = key
+                    with jwtVerifyLatency.time():
+                        token_decoded = jwt.decode(token, pubKey,
+                                                   algorithms=[algorithm])
+                    if self.cache:
+                        self.cache.put(token, token_decoded)
+                    tokenValidations.inc(result='valid')
                     self.latest = token
                     return token_decoded
                 except jwt.InvalidTokenError as e:
                     self.logger.warning("Invalid JWT: %s." % e)
+                    tokenValidations.inc(result='invalid')
             else:
                 self.logger.info("Public key not initialized.")
+                tokenValidations.inc(result='unavailable')
         else:
             self.logger.info("Empty token.")
+            tokenValidations.inc(result='empty')
         self.latest = None
 
+    def cacheStats(self):
+        """Hit and miss counters of the verified-token cache."""
+        if self.cache:
+            return self.cache.stats()
+        return {'hits': 0, 'misses': 0, 'size': 0}
+
+
+
+class MTLSAdapter(HTTPAdapter):
+    """Transport adapter that keeps MTLS connections alive and counts them.
+
+    Every new HTTPS connection pays for a full mutual TLS handshake, a
+    request over a pooled keep-alive connection pays for none. The pools
+    hold up to poolMaxSize connections for each of poolConnections hosts.
+    stats() tells how many requests reused a connection.
+    """
+    def __init__(self, poolMaxSize=POOL_MAXSIZE,
+                 poolConnections=POOL_CONNECTIONS, poolBlock=POOL_BLOCK):
+        self.statsLock = threading.Lock()
+        # Counters of the pools that were closed, per scheme
+        self.closed = {}
+        HTTPAdapter.__init__(self, pool_connections=poolConnections,
+                             pool_maxsize=poolMaxSize, pool_block=poolBlock)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pools.dispose_func = self._dispose
+
+    def _dispose(self, pool):
+        """Keep the counters of a pool that is evicted or cleared."""
+        with self.statsLock:
+            self._count(self.closed, pool)
+        pool.close()
+
+    @staticmethod
+    def _count(counters, pool):
+        connections, reqs = counters.get(pool.scheme, (0, 0))
+        counters[pool.scheme] = (connections + pool.num_connections,
+                                 reqs + pool.num_requests)
+
+    def stats(self):
+        """Connections opened and requests sent, in total and per scheme."""
+        pools = self.poolmanager.pools
+        with self.statsLock:
+            counters = dict(self.closed)
+            for key in pools.keys():
+                try:
+                    self._count(counters, pools[key])
+                except KeyError:
+                    pass  # Closed meanwhile
+        connections = sum(c for c, _ in counters.values())
+        reqs = sum(r for _, r in counters.values())
+        return {'handshakes': counters.get('https', (0, 0))[0],
+                'connections': connections,
+                'requests': reqs,
+                'reused': reqs - connections}
 
 
 class Requests():
@@ -253,66 +1516,489 @@ class Requests():
     A simple wrapper over the requests module that enforces the use of MTLS.
     Supplies client side certificate to the remote server. Always verifies
     the certificate from the remote server.
+
+    With asyncBootstrap the service certificate and the token verification
+    key are obtained by background threads, concurrently and with bounded
+    retries, and the constructor returns at once. Failed steps are tried
+    again in later rounds. isReady() tells when the credentials are in
+    place, see readinessBlueprint().
+
+    Connections are kept alive in pools of poolMaxSize per host, so that
+    repeated calls skip the TLS handshake, see connectionStats().
     """
-    def __init__(self):
-        self.latestToken = ""
+    def __init__(self, asyncBootstrap=BOOTSTRAP_ASYNC,
+                 poolMaxSize=POOL_MAXSIZE, poolConnections=POOL_CONNECTIONS,
+                 poolBlock=POOL_BLOCK):
         self.s = requests.Session()
-        if getEnvVar('TOKEN', False):
-            self.securityToken = SecurityToken(logger, DEBUG)
+        self.adapter = MTLSAdapter(poolMaxSize, poolConnections, poolBlock)
+        self.s.mount('https://', self.adapter)
+        self.s.mount('http://', self.adapter)
+        self.caCertFileName = None
+        self.ready = threading.Event()
+        self.securityToken = None
+        self.serviceCert = None
+        self.keyPool = None
+        self.revocations = None
+        self.serverContext = None
+        self.serverContextLock = threading.Lock()
+        self.peers = PeerIdentities()
+
+        if TOKEN:
+            self.securityToken = SecurityToken(logger, DEBUG,
+                                               bootstrap=not asyncBootstrap)
+        if MTLS:
+            if KEY_TYPE and (KEY_POOL_SIZE or KEY_CACHE_DIR):
+                self.keyPool = KeyPool(logger, KEY_TYPE, KEY_POOL_SIZE,
+                                       KEY_CACHE_DIR)
+            self.serviceCert = ServiceCert(logger, serviceType, DEBUG,
+                                           KEY_TYPE, self.keyPool,
+                                           bootstrap=not asyncBootstrap)
+
+        if asyncBootstrap:
+            thread = threading.Thread(target=self.bootstrapConcurrently,
+                                      name='MiSSFireBootstrap')
+            thread.daemon = True
+            thread.start()
         else:
-            self.securityToken = None
-        if getEnvVar('MTLS', False):
-            serviceCert = ServiceCert(logger, serviceType, DEBUG)
+            self.setupSession()
+            bootstrapTimer.report(logger)
+            self.ready.set()
+
+    def bootstrapConcurrently(self):
+        """Obtain the service certificate and the token key in parallel.
+
+        A step that runs out of retries is run again in another round,
+        after a backoff of up to BOOTSTRAP_MAX_BACKOFF, until both are in
+        place; the service is not ready meanwhile.
+        """
+        token, cert = self.securityToken, self.serviceCert
+        failures = 0
+        while True:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                tokenDone = certDone = None
+                if token:
+                    tokenDone = executor.submit(token.bootstrapConcurrently)
+                if cert:
+                    certDone = executor.submit(cert.bootstrapConcurrently,
+                                               executor)
+                if tokenDone and self.succeeded(tokenDone):
+                    token = None
+                if certDone and self.succeeded(certDone):
+                    cert = None
+            if not token and not cert:
+                break
+            failures += 1
+            delay = min(BOOTSTRAP_BACKOFF * 2 ** min(failures, 30),
+                        BOOTSTRAP_MAX_BACKOFF)
+            logger.error("MiSSFire bootstrap failed, service is not ready, "
+                         "next attempt in %.1fs" % delay)
+            time.sleep(delay)
+        bootstrapTimer.report(logger)
+        self.setupSession()
+        self.ready.set()
+        logger.info("MiSSFire credentials are ready")
+
+    @staticmethod
+    def succeeded(future):
+        try:
+            return future.result()
+        except Exception as e:
+            logger.error("MiSSFire bootstrap step failed: %s" % e)
+            return False
+
+    def setupSession(self):
+        """Attach the service certificate to the outbound session."""
+        if self.serviceCert:
+            serviceCert = self.serviceCert
             self.serviceCertFileName = serviceCert.getServiceCertFileName()
             self.serviceKeyFileName = serviceCert.getServiceKeyFileName()
             self.caCertFileName = serviceCert.getCaCertFileName()
 
             self.s.cert = (self.serviceCertFileName, self.serviceKeyFileName)
             self.s.verify = self.caCertFileName
+            if CERT_RENEWAL:
+                serviceCert.addRenewalListener(self.useCert)
+                serviceCert.startRenewal()
+            if REVOCATION_REFRESH_INTERVAL > 0:
+                # The list fetched by reuse() is current, no need to pull
+                # the whole feed again
+                self.revocations = serviceCert.revocations or \
+                                   RevocationList(logger, self.caCertFileName)
+                self.revocations.start()
+        if self.keyPool:
+            # Spare keys for the next certificate or the next start
+            self.keyPool.start()
+
+    def useCert(self, certFile, keyFile):
+        """Switch outbound connections to a renewed certificate.
+
+        Replacing the tuple is atomic. Idle pooled connections are closed
+        since they would reconnect with the previous key file; requests in
+        flight finish on their connection, which is closed afterwards.
+        """
+        self.s.cert = (certFile, keyFile)
+        for adapter in self.s.adapters.values():
+            adapter.poolmanager.clear()
+
+    def isReady(self):
+        """True once MTLS and token credentials are in place."""
+        return self.ready.is_set()
+
+    def isRevoked(self, serial):
+        """True if the certificate with this serial number was revoked."""
+        return self.revocations is not None and \
+               self.revocations.isRevoked(serial)
+
+    def serverSSLContext(self):
+        """The ServerSSLContext of this service, created on first use.
+
+        Follows renewals of the service certificate.
+        """
+        with self.serverContextLock:
+            if self.serverContext is None:
+                if not self.ready.wait(BOOTSTRAP_WAIT) or not self.serviceCert:
+                    raise RuntimeError("No service certificate for MTLS")
+                self.serverContext = ServerSSLContext(
+                    self.serviceCert.getServiceCertFileName(),
+                    self.serviceCert.getServiceKeyFileName(),
+                    self.serviceCert.getCaCertFileName())
+                self.serviceCert.addRenewalListener(self.serverContext.load)
+            return self.serverContext
+
+    def connectionStats(self):
+        """Full TLS handshakes versus requests over reused connections."""
+        return self.adapter.stats()
+
+    def setToken(self, token):
+        """Propagate token on the outbound calls of the current request.
+
+        The token is kept in Flask's 'g', which is private to the request
+        being served also with threaded or gevent workers, and is dropped
+        when the request ends.
+        """
+        g.missfireToken = token
 
+    def currentToken(self):
+        """Token of the request being served, '' outside of a request."""
+        if has_app_context():
+            return getattr(g, 'missfireToken', '')
+        return ''
 
     def format(self, *args, **kwargs):
         if self.securityToken:
-            if self.latestToken and len(self.latestToken) > 0:
-                if 'json' not in kwargs:
-                    kwargs['json'] = {}
-                kwargs['json']['access_token'] = self.latestToken
+            token = self.currentToken()
+            if token:
+                if TOKEN_PROPAGATION in ('header', 'both'):
+                    headers = dict(kwargs.get('headers') or {})
+                    headers.setdefault('Authorization', 'Bearer ' + token)
+                    kwargs['headers'] = headers
+                if TOKEN_PROPAGATION in ('json', 'both'):
+                    if 'json' not in kwargs:
+                        kwargs['json'] = {}
+                    kwargs['json']['access_token'] = token
             else:
-                logger.warning("'self.latestToken' in memory is empty.")
+                logger.warning("No token to propagate in this context.")
+        rid = requestId()
+        if rid:
+            headers = dict(kwargs.get('headers') or {})
+            headers.setdefault('X-Request-ID', rid)
+            kwargs['headers'] = headers
 
         kwargs['allow_redirects'] = False
         kwargs['stream'] = False
+        if not self.ready.wait(BOOTSTRAP_WAIT):
+            logger.warning("Outbound request before MiSSFire is ready.")
+        if self.caCertFileName:
+            # Passed per request: REQUESTS_CA_BUNDLE in the environment
+            # would take precedence over the session setting.
+            kwargs['verify'] = self.caCertFileName
         return (args, kwargs)
 
-    def get(self, *args, **kwargs):
-        (newArgs, newKwargs) = self.format(*args, **kwargs)
-        return self.s.get(*newArgs, **newKwargs)
+    def send(self, method, url, kwargs):
+        """Send a formatted call over the MTLS session, timing it."""
+        host = urlparse.urlsplit(url).netloc
+        try:
+            with outboundLatency.time(method=method, host=host):
+                return self.s.request(method, url, **kwargs)
+        except Exception:
+            outboundErrors.inc(method=method, host=host)
+            raise
+
+    def get(self, url, params=None, **kwargs):
+        """Same arguments as requests.get."""
+        if params is not None:
+            kwargs['params'] = params
+        (_, newKwargs) = self.format(**kwargs)
+        return self.send('GET', url, newKwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        """Same arguments as requests.post."""
+        if data is not None:
+            kwargs['data'] = data
+        if json is not None:
+            kwargs['json'] = json
+        (_, newKwargs) = self.format(**kwargs)
+        return self.send('POST', url, newKwargs)
+
+
+class ConcurrentRequests():
+    """Concurrent outbound calls with the MTLS and token handling of Requests.
+
+    Fans out to several services at once, so that a gateway waits for its
+    slowest dependency rather than for the sum of all of them:
+
+        fanOut = ConcurrentRequests(secureRequests)
+        calls = [fanOut.get(usersUrl), fanOut.post(accountsUrl, json=data)]
+        users, accounts = fanOut.gather(calls, timeout=5)
+
+    Every call is prepared by Requests.format() in the calling thread, so
+    it carries the token of the request being served, and is sent over the
+    shared MTLS session by a worker thread. At most hostLimit calls run
+    against one host at a time.
+    """
+    def __init__(self, reqs, maxWorkers=FANOUT_WORKERS,
+                 hostLimit=FANOUT_HOST_LIMIT, timeout=FANOUT_TIMEOUT):
+        self.reqs = reqs
+        self.hostLimit = hostLimit
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers)
+        self.hosts = {}
+        self.hostsLock = threading.Lock()
+
+    def hostSemaphore(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self.hostsLock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.hostLimit)
+            return self.hosts[host]
+
+    def _send(self, method, url, kwargs):
+        with self.hostSemaphore(url):
+            return self.reqs.send(method, url, kwargs)
+
+    def request(self, method, url, **kwargs):
+        """Start a call, return a Future of its response."""
+        kwargs.setdefault('timeout', self.timeout)
+        (_, newKwargs) = self.reqs.format(**kwargs)
+        return self.executor.submit(self._send, method, url, newKwargs)
+
+    def get(self, url, params=None, **kwargs):
+        if params is not None:
+            kwargs['params'] = params
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        if data is not None:
+            kwargs['data'] = data
+        if json is not None:
+            kwargs['json'] = json
+        return self.request('POST', url, **kwargs)
+
+    def gather(self, futures, timeout=None, returnExceptions=False):
+        """Wait for calls to finish, return their responses in order.
+
+        Calls that have not started when timeout seconds have passed are
+        cancelled; calls already running are bounded by their request
+        timeout. The first failure is raised, or with returnExceptions
+        the exception takes the place of the response.
+        """
+        done, notDone = wait(futures, timeout)
+        for future in notDone:
+            future.cancel()
+        results = []
+        for future in futures:
+            if future in notDone:
+                error = FuturesTimeoutError("Call unfinished after %s seconds"
+                                            % timeout)
+            elif future.cancelled():
+                error = CancelledError()
+            else:
+                error = future.exception()
+            if error is None:
+                results.append(future.result())
+            elif returnExceptions:
+                results.append(error)
+            else:
+                raise error
+        return results
+
+    def close(self):
+        """Stop the worker threads once queued calls are sent."""
+        self.executor.shutdown(wait=False)
+
+
+class LazyRequests():
+    """Stands in for the Requests of this process until it is first used.
+
+    Importing MiSSFire then obtains no credentials, so a test, a benchmark
+    or a tool that only needs a helper does not bootstrap.
+    """
+    def __getattr__(self, name):
+        return getattr(bootstrap(), name)
+
 
-    def post(self, *args,**kwargs):
-        (newArgs, newKwargs) = self.format(*args, **kwargs)
-        return self.s.post(*newArgs, **newKwargs)
+# Created by the first bootstrap()
+requestsInstance = None
+requestsLock = threading.Lock()
 
 
-# MTLS certificates should be in place before Gunicorn web server starts.  
-secureRequests = Requests()
+def bootstrap():
+    """Return the Requests of this process, created on the first call.
+
+    MTLS certificates should be in place before Gunicorn web server starts:
+    call this from the app module, or from the Gunicorn config when the
+    app is not preloaded. Workers forked afterwards share the result.
+    """
+    global requestsInstance
+    with requestsLock:
+        if requestsInstance is None:
+            requestsInstance = Requests()
+        return requestsInstance
+
+
+secureRequests = LazyRequests()
+
+
+def readinessBlueprint(reqs, url='/ready'):
+    """Flask blueprint with a readiness probe for the orchestrator.
+
+    Answers 200 once the credentials of reqs are in place, 503 before.
+    Usage: app.register_blueprint(readinessBlueprint(secureRequests))
+    """
+    blueprint = Blueprint('missfire_readiness', __name__)
+
+    @blueprint.route(url, methods=['GET'])
+    def readiness():
+        if reqs.isReady():
+            return 'Ready', 200
+        return 'Not ready', 503
+
+    return blueprint
+
+
+def metricsBlueprint(reqs, url='/metrics'):
+    """Flask blueprint serving the metrics of this process.
+
+    Prometheus text format: token validations, JWT verification and
+    outbound call latencies, MTLS handshakes and connection reuse, and
+    time to expiry of the service certificate. Behind gunicorn every
+    worker reports its own.
+    Usage: app.register_blueprint(metricsBlueprint(secureRequests))
+    """
+    blueprint = Blueprint('missfire_metrics', __name__)
+
+    metrics.gauge('missfire_tls_handshakes_total',
+                  "Outbound connections opened with a full TLS handshake",
+                  lambda: reqs.connectionStats()['handshakes'],
+                  kind='counter')
+    metrics.gauge('missfire_connections_reused_total',
+                  "Outbound calls sent over a kept-alive connection",
+                  lambda: reqs.connectionStats()['reused'], kind='counter')
+    if reqs.securityToken:
+        metrics.gauge('missfire_token_cache_hits_total',
+                      "Tokens found in the verified-token cache",
+                      lambda: reqs.securityToken.cacheStats()['hits'],
+                      kind='counter')
+    if reqs.serviceCert:
+        metrics.gauge('missfire_cert_expiry_seconds',
+                      "Seconds until the service certificate expires",
+                      lambda: reqs.serviceCert.renewalStats()['secondsToExpiry'])
+        metrics.gauge('missfire_cert_renewals_total',
+                      "Renewals of the service certificate",
+                      lambda: reqs.serviceCert.renewals, kind='counter')
+
+    @blueprint.route(url, methods=['GET'])
+    def serveMetrics():
+        return metrics.render(), 200, {'Content-type': metrics.CONTENT_TYPE}
+
+    return blueprint
+
+
+def requestToken():
+    """Token of the inbound request, or None.
+
+    Taken from the 'Authorization: Bearer' header, so the body is not
+    parsed; requests from services that still send the token in the
+    'access_token' field of a JSON body are accepted too.
+    """
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() == 'bearer' and token.strip():
+        return token.strip()
+    body = request.get_json(silent=True)
+    if isinstance(body, dict) and body.get('access_token'):
+        return body['access_token']
+    return None
+
+
+def peerCertificate():
+    """DER certificate of the MTLS peer of the inbound request, or None.
+
+    Taken from the connection when served by gunicorn, or from the PEM in
+    SSL_CLIENT_CERT when the server passes it in the environment.
+    """
+    sock = request.environ.get('gunicorn.socket')
+    if isinstance(sock, ssl.SSLSocket):
+        try:
+            return sock.getpeercert(binary_form=True)
+        except ValueError:
+            # Gunicorn leaves the handshake to the first read, which Python
+            # 2 does not count as done; completing it again is a no-op.
+            sock.do_handshake()
+            return sock.getpeercert(binary_form=True)
+    pem = request.environ.get('SSL_CLIENT_CERT')
+    if pem:
+        return ssl.PEM_cert_to_DER_cert(pem)
+    return None
+
+
+def peer_conditional(reqs, allowed=None):
+    """Only let services of the allowed types call the endpoint.
+
+    The caller is identified by its verified MTLS certificate; allowed is
+    a list of service types, None allows any service of the CA. Revoked
+    certificates are refused. The identity of the caller is available
+    in g.missfirePeer.
+    """
+    allowed = set(allowed) if allowed is not None else None
+    def real_decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kws):
+            if not reqs.isReady():
+                logger.warning("Request received before MiSSFire is ready.")
+                abort(503)
+            der = peerCertificate()
+            if not der:
+                logger.warning("No peer certificate in the request.")
+                abort(401)
+            peer = reqs.peers.get(der)
+            if reqs.isRevoked(peer.serial):
+                logger.warning("Peer certificate %X is revoked." % peer.serial)
+                abort(403)
+            if allowed is not None and peer.serviceType not in allowed:
+                logger.warning("Service '%s' may not call this endpoint."
+                               % peer.serviceType)
+                abort(403)
+            g.missfirePeer = peer
+            return f(*args, **kws)
+        return decorated_function
+    return real_decorator
 
 
 def jwt_conditional(reqs):
     def real_decorator(f):
         @wraps(f)
         def decorated_function(*args, **kws):
-            #logger.info("request.json: %s" % request.json)
-            if not request.json or not 'access_token' in request.json or \
-                len(request.json['access_token']) == 0:
+            if not reqs.isReady():
+                logger.warning("Request received before MiSSFire is ready.")
+                abort(503)
+            token = requestToken()
+            if not token:
                 logger.warning("'access_token' not found in the request.")
                 abort(401)
-            token = request.json['access_token']
-            if reqs.securityToken.validate(token):
-                reqs.latestToken = token
-            else:
-                reqs.latestToken = ""
+            if not reqs.securityToken.validate(token):
                 logger.warning("'access_token' is invalid.")
                 abort(403)
+            reqs.setToken(token)
             return f(*args, **kws)
         return decorated_function
     return real_decorator
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import time
+import uuid
+import Queue
+import logging
+import datetime
+import threading
+
+from flask import g, has_request_context, request
+
+# Disable console messages from Flask server
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+# 'json' writes one JSON object per record, 'text' a human readable line
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Level of the root logger, e.g. INFO; unset leaves it as it is
+LOG_LEVEL = os.getenv('LOG_LEVEL')
+# Records waiting to be written; when full, new records are dropped
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Records a single log statement may emit per LOG_RATE_PERIOD seconds,
+# 0 disables rate limiting. Errors are never rate limited.
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', 100))
+LOG_RATE_PERIOD = float(os.getenv('LOG_RATE_PERIOD', 1))
+
+TEXT_FORMAT = "%(asctime)s - %(filename)s - %(funcName)s - %(lineno)s - %(levelname)s - %(message)s"
+
+# Set by the first log() instance, see setup()
+queueHandler = None
+setupLock = threading.Lock()
+
+
+def requestId():
+    """ID of the request being served, None outside of a request.
+
+    Taken from the X-Request-ID header so that a request can be followed
+    across services, or generated once per request.
+    """
+    if not has_request_context():
+        return None
+    rid = getattr(g, 'requestId', None)
+    if rid is None:
+        rid = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        g.requestId = rid
+    return rid
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single line JSON object."""
+    def __init__(self, serviceName):
+        logging.Formatter.__init__(self)
+        self.serviceName = serviceName
+
+    def format(self, record):
+        entry = {'time': datetime.datetime.utcfromtimestamp(
+                     record.created).isoformat() + 'Z',
+                 'level': record.levelname,
+                 'service': self.serviceName,
+                 'logger': record.name,
+                 'file': record.filename,
+                 'func': record.funcName,
+                 'line': record.lineno,
+                 'message': record.getMessage()}
+        for attr in ('requestId', 'suppressed'):
+            if getattr(record, attr, None):
+                entry[attr] = getattr(record, attr)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the request ID and drops records of over-active log statements.
+
+    Runs on the thread that logs, where the request context is available.
+    Each log statement, i.e. file and line, may emit up to limit records
+    per period seconds; the number of records dropped is reported with
+    the next record that gets through.
+    """
+    def __init__(self, limit=LOG_RATE_LIMIT, period=LOG_RATE_PERIOD):
+        logging.Filter.__init__(self)
+        self.limit = limit
+        self.period = period
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        record.requestId = requestId()
+        if self.limit <= 0 or record.levelno >= logging.ERROR:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.time()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                if window and window[2]:
+                    record.suppressed = window[2]
+                self.windows[key] = [now, 1, 0]
+                return True
+            if window[1] < self.limit:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class QueueHandler(logging.Handler):
+    """Puts records on a queue, written out by a background thread.
+
+    The logging thread does not format or write anything; when the queue
+    is full the record is dropped and counted instead of blocking. A
+    forked process, e.g. a gunicorn worker, starts its own writer thread.
+    """
+    def __init__(self, handler, size=LOG_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.size = size
+        self.dropped = 0
+        self.pid = None
+        self.queue = None
+        self.writer = None
+
+    def start(self):
+        self.queue = Queue.Queue(self.size)
+        self.writer = threading.Thread(target=self._write, args=(self.queue,),
+                                       name='LogWriter')
+        self.writer.daemon = True
+        self.writer.start()
+        self.pid = os.getpid()
+
+    def _write(self, queue):
+        while True:
+            record = queue.get()
+            if record is None:
+                break
+            try:
+                self.handler.handle(record)
+            except Exception:
+                pass
+
+    def emit(self, record):
+        try:
+            if self.pid != os.getpid():
+                self.start()
+            # Merge the arguments now, they may change before the record
+            # is written.
+            record.msg = record.getMessage()
+            record.args = None
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        """Write the queued records, called by logging at exit."""
+        if self.pid == os.getpid():
+            try:
+                self.queue.put(None, timeout=2)
+                self.writer.join(2)
+            except Queue.Full:
+                pass
+        logging.Handler.close(self)
+
+
+def setup(serviceName):
+    """Route the root logger through a queue to stderr, once per process."""
+    global queueHandler
+    with setupLock:
+        if queueHandler is not None:
+            return
+        handler = logging.StreamHandler(sys.stderr)
+        if LOG_FORMAT == 'json':
+            handler.setFormatter(JsonFormatter(serviceName))
+        else:
+            handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        queueHandler = QueueHandler(handler)
+        queueHandler.addFilter(ContextFilter())
+
+        root = logging.getLogger()
+        root.addHandler(queueHandler)
+        if LOG_LEVEL:
+            root.setLevel(LOG_LEVEL.upper())
+
+
+class log:
+    def __init__(self, service_name,):
+        self.service_name = service_name
+        self.logger = logging.getLogger()
+
+        # Install the queue and console handlers, only the first time
+        setup(service_name)
+
+        # Install service-wide exception handler
+        #sys.excepthook = self.my_handler
+
+    # Handle all uncaught exceptions
+    def my_handler(self, type, value, tb):
+        self.logger.exception("Uncaught exception:", exc_info=(type, value, tb))
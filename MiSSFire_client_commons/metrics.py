@@ -0,0 +1,168 @@
+import time
+import bisect
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+                         .replace('\n', '\\n')
+
+
+def formatLabels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                             for name, value in pairs)
+
+
+def labelKey(labelNames, labels):
+    return tuple(labels.get(name, '') for name in labelNames)
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter():
+    """Monotonically increasing count, per combination of label values."""
+    kind = 'counter'
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = labelKey(self.labelNames, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield self.name, zip(self.labelNames, key), value
+
+
+class Histogram():
+    """Distribution of observed values, e.g. latencies in seconds."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = labelKey(self.labelNames, labels)
+        # Bucket i counts values up to buckets[i], the last one the rest
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1),
+                                             0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the with block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            series = sorted((key, (list(s[0]), s[1], s[2]))
+                            for key, s in self.series.items())
+        for key, (counts, total, count) in series:
+            labels = zip(self.labelNames, key)
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                yield (self.name + '_bucket',
+                       labels + [('le', formatValue(bound))], cumulative)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class Gauge():
+    """Value read from a function when the metrics are rendered.
+
+    With kind 'counter' it reports a count kept elsewhere.
+    """
+    def __init__(self, name, help, func, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, [], self.func()
+
+
+class Registry():
+    """The metrics of a process, rendered in the Prometheus text format.
+
+    Metrics are kept per process: behind gunicorn every worker reports its
+    own.
+    """
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, or return the one already registered by its name."""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelNames=()):
+        return self.register(Counter(name, help, labelNames))
+
+    def histogram(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelNames, buckets))
+
+    def gauge(self, name, help, func, kind='gauge'):
+        return self.register(Gauge(name, help, func, kind))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append('%s%s %s' % (name, formatLabels(labels),
+                                              formatValue(value)))
+            except Exception:
+                continue  # A gauge that cannot be read is left out
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge = REGISTRY.gauge
+render = REGISTRY.render
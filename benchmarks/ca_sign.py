@@ -0,0 +1,113 @@
+"""CSR signing throughput of the CA service.
+
+Compares the former 'openssl ca' subprocess path (CSR written to a file,
+signed by a forked openssl process, PEM read back) with the in-process
+CertSigner. Run from the repository root:
+
+    python benchmarks/ca_sign.py [-n 200]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CA_DIR = os.path.join(ROOT, 'services', 'ca', 'ca')
+sys.path.insert(0, CA_DIR)
+
+from signer import CertSigner
+from store import IssuanceStore
+
+
+def setupCA(workDir):
+    shutil.copy(os.path.join(CA_DIR, 'openssl-ca.cnf'), workDir)
+    open(os.path.join(workDir, 'index.txt'), 'a').close()
+    with open(os.path.join(workDir, 'serial.txt'), 'w') as f:
+        f.write('01')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            "openssl req -x509 -config openssl-ca.cnf -newkey rsa:4096 "
+            "-sha256 -nodes -out cacert.pem -outform PEM",
+            shell=True, cwd=workDir, stdout=devnull, stderr=devnull)
+
+
+def genCSRs(count):
+    backend = default_backend()
+    key = rsa.generate_private_key(65537, 2048, backend)
+    csrs = []
+    for i in range(count):
+        subject = x509.Name([
+            x509.NameAttribute(NameOID.COUNTRY_NAME, u'NO'),
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, u'UiB'),
+            x509.NameAttribute(NameOID.COMMON_NAME, u'bench-%d' % i),
+        ])
+        csr = x509.CertificateSigningRequestBuilder() \
+            .subject_name(subject) \
+            .add_extension(x509.SubjectAlternativeName(
+                [x509.DNSName(u'localhost')]), critical=False) \
+            .sign(key, hashes.SHA256(), backend)
+        csrs.append(csr.public_bytes(serialization.Encoding.PEM))
+    return csrs
+
+
+def signOpenSSL(workDir, csrs):
+    with open(os.devnull, 'w') as devnull:
+        for i, csr in enumerate(csrs):
+            fileId = os.path.join(workDir, 'req%d' % i)
+            with open(fileId + '.csr', 'wb') as f:
+                f.write(csr)
+            subprocess.check_call(
+                "openssl ca -batch -config openssl-ca.cnf -policy signing_policy "
+                "-extensions signing_req -out %s.pem -infiles %s.csr"
+                % (fileId, fileId),
+                shell=True, cwd=workDir, stdout=devnull, stderr=devnull)
+            with open(fileId + '.pem', 'r') as f:
+                f.read()
+
+
+def signInProcess(workDir, csrs):
+    store = IssuanceStore(os.path.join(workDir, 'ca.db'))
+    signer = CertSigner(store, os.path.join(workDir, 'cacert.pem'),
+                        os.path.join(workDir, 'cakey.pem'))
+    for csr in csrs:
+        signer.sign(csr, 'bench')
+
+
+def measure(name, func, workDir, csrs):
+    start = time.time()
+    func(workDir, csrs)
+    elapsed = time.time() - start
+    rate = len(csrs) / elapsed
+    print("%-12s %6d CSRs in %7.3f s  %8.1f signatures/s"
+          % (name, len(csrs), elapsed, rate))
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=200, help="number of CSRs")
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='missfire-ca-bench-')
+    try:
+        setupCA(workDir)
+        csrs = genCSRs(args.n)
+        before = measure('openssl ca', signOpenSSL, workDir, csrs)
+        after = measure('CertSigner', signInProcess, workDir, csrs)
+        print("speedup      %.1fx" % (after / before))
+    finally:
+        shutil.rmtree(workDir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+"""End-to-end latency and throughput of the MiSSFire security path.
+
+Starts the CA (port 8080) and the reverse STS (port 8081) from a scratch
+copy of services/, and a dummy functional service behind gunicorn that
+uses MiSSFire.Requests and jwt_conditional, then measures:
+
+  ca_sign          CSR signing, one CSR per /ca/sign call
+  ca_sign_batch    CSR signing through /ca/sign/batch
+  sts_login        token issuance, one token per /login call
+  sts_login_batch  token issuance through /login/batch
+  jwt_validate     SecurityToken.validate() of new tokens
+  jwt_cached       SecurityToken.validate() of a token seen before
+  mtls_handshake   calls on a new connection, a full MTLS handshake each
+  mtls_reused      calls over a kept-alive MTLS connection
+  hop_mtls         a call to the dummy service, MTLS only
+  hop_jwt          the same with a token validated by jwt_conditional
+  hop_propagated   the same plus one more hop with the propagated token
+  cold_start       bootstrap of MiSSFire in a new directory: key, CSR,
+                   CA signature and token keys
+
+The client cannot resume TLS sessions on Python 2.7, so a resumed call
+is one over a kept-alive connection. Results are written as JSON; with
+--baseline the median latencies are compared with an earlier result and
+the exit status is 1 if any regressed by more than --tolerance.
+
+Python 2.7 with the service requirements; the services run as outside of
+Docker, see IN_DOCKER in missfire_config:
+
+    python benchmarks/end_to_end.py [-n 200] [-o result.json]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import ssl
+import shutil
+import signal
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+
+import requests
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES_DIR = os.path.join(ROOT, 'services')
+COMMONS_DIR = os.path.join(ROOT, 'MiSSFire_client_commons')
+COMMONS_FILES = ('MiSSFire.py', 'missfire_config.py', 'logger_client.py',
+                 'metrics.py')
+SERVICE_CONFIG = os.path.join(SERVICES_DIR, 'reversests', 'reversests',
+                              'openssl-service.cnf')
+
+# Same addresses as MiSSFire uses outside of Docker
+CA_URL = 'https://0.0.0.0:8080/'
+TOKEN_URL = 'http://0.0.0.0:8081/'
+SERVICE_PORT = 8443
+SERVICE_URL = 'https://0.0.0.0:%d/' % SERVICE_PORT
+
+DUMMY_APP = '''
+import MiSSFire
+from flask import Flask
+
+app = Flask(__name__)
+reqs = MiSSFire.bootstrap()
+MiSSFire.useInGunicorn(reqs.serverSSLContext())
+
+
+@app.route('/plain', methods=['POST'])
+def plain():
+    return 'ok'
+
+
+@app.route('/protected', methods=['POST'])
+@MiSSFire.jwt_conditional(reqs)
+def protected():
+    return 'ok'
+
+
+@app.route('/hop', methods=['POST'])
+@MiSSFire.jwt_conditional(reqs)
+def hop():
+    res = reqs.post('%(url)sprotected')
+    return 'ok', res.status_code
+'''
+
+
+class Services():
+    """The CA, the reverse STS and the dummy service, in a scratch dir."""
+    def __init__(self, workDir):
+        self.workDir = workDir
+        self.processes = []
+        self.env = dict(os.environ, MTLS='True', TOKEN='True',
+                        SERVICE_DEBUG='True', LOG_LEVEL='WARNING',
+                        IN_DOCKER='False',
+                        PYTHONPATH=os.getenv('PYTHONPATH', ''))
+
+    def start(self):
+        self.startService('ca', ['api.py'], CA_URL)
+        self.startService('reversests', ['api.py'], TOKEN_URL)
+        serviceDir = self.serviceDir('dummy')
+        with open(os.path.join(serviceDir, 'app.py'), 'w') as f:
+            f.write(DUMMY_APP % {'url': SERVICE_URL})
+        self.run('dummy', serviceDir, [
+            '-c', 'from gunicorn.app.wsgiapp import run; run()',
+            '--bind', '0.0.0.0:%d' % SERVICE_PORT, '--preload',
+            '--worker-class', 'gthread', '--threads', '8',
+            '--certfile', 'servicecert.pem', '--keyfile', 'servicekey.key',
+            '--ca-certs', 'cacert.pem', '--cert-reqs', '2', 'app:app'])
+        waitFor(SERVICE_URL, 120)
+
+    def startService(self, name, args, url):
+        workDir = os.path.join(self.workDir, name)
+        shutil.copytree(os.path.join(SERVICES_DIR, name, name), workDir)
+        self.run(name, workDir, args)
+        waitFor(url, 60)
+
+    def serviceDir(self, name):
+        """A functional service directory with the client commons."""
+        workDir = os.path.join(self.workDir, name)
+        os.mkdir(workDir)
+        for fileName in COMMONS_FILES:
+            shutil.copy(os.path.join(COMMONS_DIR, fileName), workDir)
+        shutil.copy(SERVICE_CONFIG, workDir)
+        return workDir
+
+    def run(self, name, cwd, args):
+        logFile = open(os.path.join(self.workDir, name + '.log'), 'w')
+        env = dict(self.env)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+            cwd, self.env['PYTHONPATH']]))
+        # A process group per service, the CA and the STS fork a reloader
+        self.processes.append(subprocess.Popen(
+            [sys.executable] + args, cwd=cwd, env=env, stdout=logFile,
+            stderr=subprocess.STDOUT, preexec_fn=os.setsid))
+
+    def stop(self):
+        for process in reversed(self.processes):
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait()
+            except OSError:
+                pass
+
+
+def waitFor(url, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            requests.get(url, verify=False, timeout=5)
+            return
+        except requests.exceptions.SSLError:
+            return  # Up, but wants a client certificate
+        except requests.exceptions.ConnectionError:
+            if time.time() > deadline:
+                raise RuntimeError("%s did not start" % url)
+            time.sleep(0.5)
+
+
+def summarize(samples, items=None):
+    """Latency percentiles in ms and the rate of calls, or of items."""
+    samples = sorted(samples)
+    count = len(samples)
+    total = sum(samples)
+    pick = lambda q: samples[min(count - 1, int(q * count))] * 1000
+    return {'count': count,
+            'mean_ms': total / count * 1000,
+            'p50_ms': pick(0.5),
+            'p90_ms': pick(0.9),
+            'p99_ms': pick(0.99),
+            'per_second': (items or count) / total}
+
+
+def timed(func, count):
+    samples = []
+    for i in range(count):
+        start = time.time()
+        func(i)
+        samples.append(time.time() - start)
+    return samples
+
+
+def check(res):
+    if res.status_code != 200:
+        raise RuntimeError("%s %s: %s" % (res.request.method, res.url,
+                                          res.status_code))
+    return res
+
+
+def genCSRs(count):
+    backend = default_backend()
+    key = rsa.generate_private_key(65537, 2048, backend)
+    csrs = []
+    for i in range(count):
+        subject = x509.Name([
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, u'UiB'),
+            x509.NameAttribute(NameOID.COMMON_NAME, u'bench-%d' % i),
+        ])
+        csr = x509.CertificateSigningRequestBuilder() \
+            .subject_name(subject) \
+            .sign(key, hashes.SHA256(), backend)
+        csrs.append(csr.public_bytes(serialization.Encoding.PEM))
+    return csrs
+
+
+def benchCA(results, count, caCert):
+    session = requests.Session()
+    session.verify = caCert
+    csrs = genCSRs(count)
+    url = CA_URL + 'ca/sign'
+    results['ca_sign'] = summarize(timed(lambda i: check(session.post(
+        url, json={'token': 'secret', 'serviceType': 'bench',
+                   'csr': csrs[i]})), count))
+    batch = [{'serviceType': 'bench', 'csr': csr} for csr in csrs]
+    url = CA_URL + 'ca/sign/batch'
+    results['ca_sign_batch'] = summarize(timed(lambda i: check(session.post(
+        url, json={'token': 'secret', 'requests': batch})), 1), count)
+
+
+def benchSTS(results, count):
+    session = requests.Session()
+    results['sts_login'] = summarize(timed(lambda i: check(session.post(
+        TOKEN_URL + 'login', json={'username': 'user%d' % i})), count))
+    usernames = ['user%d' % i for i in range(count)]
+    tokens = []
+    results['sts_login_batch'] = summarize(timed(lambda i: tokens.extend(
+        check(session.post(TOKEN_URL + 'login/batch',
+                           json={'usernames': usernames}))
+        .json()['access_tokens']), 1), count)
+    return tokens
+
+
+def benchJWT(results, securityToken, tokens):
+    if not all(securityToken.validate(token) for token in tokens[:1]):
+        raise RuntimeError("Tokens of the STS do not validate")
+    # The first token is cached now, the others are not
+    results['jwt_validate'] = summarize(timed(
+        lambda i: securityToken.validate(tokens[i + 1]), len(tokens) - 1))
+    results['jwt_cached'] = summarize(timed(
+        lambda i: securityToken.validate(tokens[0]), len(tokens)))
+
+
+def benchMTLS(results, reqs, count, token):
+    url = SERVICE_URL + 'plain'
+    cert = reqs.s.cert
+    caCert = reqs.caCertFileName
+    results['mtls_handshake'] = summarize(timed(lambda i: check(
+        requests.post(url, cert=cert, verify=caCert)), count))
+    session = reqs.s
+    check(session.post(url, verify=caCert))
+    results['mtls_reused'] = summarize(timed(lambda i: check(
+        session.post(url, verify=caCert)), count))
+
+    headers = {'Authorization': 'Bearer ' + token}
+    for name, path in (('hop_mtls', 'plain'), ('hop_jwt', 'protected'),
+                       ('hop_propagated', 'hop')):
+        url = SERVICE_URL + path
+        check(session.post(url, headers=headers, verify=caCert))
+        results[name] = summarize(timed(lambda i: check(session.post(
+            url, headers=headers, verify=caCert)), count))
+
+
+COLD_START = ("import time; start = time.time(); import MiSSFire; "
+              "MiSSFire.bootstrap(); print(time.time() - start)")
+
+
+def benchColdStart(results, services, count):
+    samples = []
+    for i in range(count):
+        workDir = services.serviceDir('coldstart%d' % i)
+        env = dict(services.env)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+            workDir, env['PYTHONPATH']]))
+        with open(workDir + '.log', 'w') as logFile:
+            output = subprocess.check_output(
+                [sys.executable, '-c', COLD_START], cwd=workDir, env=env,
+                stderr=logFile)
+        samples.append(float(output.strip().splitlines()[-1]))
+    results['cold_start'] = summarize(samples)
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of median latencies, return the regressions."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['p50_ms']
+        after = results[name]['p50_ms']
+        change = after / before - 1 if before else 0
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("%-16s %10.3f -> %10.3f ms  %+6.1f%%%s"
+              % (name, before, after, change * 100, flag))
+    return regressions
+
+
+def environment():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                             cwd=ROOT, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': datetime.datetime.utcnow().isoformat() + 'Z',
+            'commit': commit,
+            'python': platform.python_version(),
+            'openssl': ssl.OPENSSL_VERSION,
+            'platform': platform.platform()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=200,
+                        help="calls per measurement")
+    parser.add_argument('--cold', type=int, default=5,
+                        help="cold starts to measure")
+    parser.add_argument('-o', '--output', default='end_to_end.json',
+                        help="result file")
+    parser.add_argument('--baseline', help="earlier result file to compare")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown of a median, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='missfire-e2e-')
+    services = Services(workDir)
+    results = {}
+    try:
+        services.start()
+        # The measuring client is a MiSSFire service itself, without the
+        # background threads that it does not need
+        os.chdir(services.serviceDir('client'))
+        os.environ.update(services.env, CERT_RENEWAL='False',
+                          REVOCATION_REFRESH_INTERVAL='0')
+        sys.path.insert(0, os.getcwd())
+        import MiSSFire
+        reqs = MiSSFire.bootstrap()
+
+        benchCA(results, args.n, reqs.caCertFileName)
+        tokens = benchSTS(results, args.n)
+        benchJWT(results, reqs.securityToken, tokens)
+        benchMTLS(results, reqs, args.n, tokens[0])
+        benchColdStart(results, services, args.cold)
+    except Exception:
+        print("Service logs are kept in %s" % workDir)
+        raise
+    finally:
+        services.stop()
+        os.chdir(ROOT)
+    shutil.rmtree(workDir)
+
+    print("%-16s %10s %10s %10s %12s" % ('', 'p50 ms', 'p90 ms', 'p99 ms',
+                                         'per second'))
+    for name in sorted(results):
+        r = results[name]
+        print("%-16s %10.3f %10.3f %10.3f %12.1f"
+              % (name, r['p50_ms'], r['p90_ms'], r['p99_ms'], r['per_second']))
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'calls': args.n,
+                   'results': results}, f, indent=2, sort_keys=True)
+    print("Results written to %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Token issue and verify throughput per JWT algorithm.
+
+Signs and verifies the same claims as the reverse STS with each supported
+asymmetric algorithm and reports operations per second and token size.
+EdDSA is included when the installed PyJWT and cryptography support it.
+
+    python benchmarks/jwt_algorithms.py [-n 1000]
+"""
+import time
+import uuid
+import argparse
+import datetime
+
+import jwt
+from jwt.algorithms import get_default_algorithms
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
+
+
+def rsaKey():
+    return rsa.generate_private_key(65537, 2048, default_backend())
+
+
+def ecKey(curve):
+    return lambda: ec.generate_private_key(curve, default_backend())
+
+
+def edKey():
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+    return ed25519.Ed25519PrivateKey.generate()
+
+
+ALGORITHMS = [
+    ('RS256', rsaKey),
+    ('PS256', rsaKey),
+    ('ES256', ecKey(ec.SECP256R1())),
+    ('ES384', ecKey(ec.SECP384R1())),
+    ('EdDSA', edKey),
+]
+
+
+def claims():
+    now = datetime.datetime.utcnow()
+    return {'jti': str(uuid.uuid4()), 'identity': 'test', 'type': 'access',
+            'fresh': False, 'iat': now, 'nbf': now,
+            'exp': now + datetime.timedelta(minutes=10)}
+
+
+def measure(func, count):
+    start = time.time()
+    for _ in range(count):
+        func()
+    return count / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=1000,
+                        help="tokens per algorithm")
+    args = parser.parse_args()
+
+    supported = get_default_algorithms()
+    print("%-6s %12s %12s %8s" % ('alg', 'issue/s', 'verify/s', 'bytes'))
+    for name, newKey in ALGORITHMS:
+        if name not in supported:
+            print("%-6s not supported by this PyJWT/cryptography" % name)
+            continue
+        key = newKey()
+        pubKey = key.public_key()
+        payload = claims()
+        token = jwt.encode(payload, key, algorithm=name)
+        issueRate = measure(lambda: jwt.encode(payload, key, algorithm=name),
+                            args.n)
+        verifyRate = measure(lambda: jwt.decode(token, pubKey,
+                                                algorithms=[name]), args.n)
+        print("%-6s %12.1f %12.1f %8d" % (name, issueRate, verifyRate,
+                                          len(token)))
+
+
+if __name__ == "__main__":
+    main()
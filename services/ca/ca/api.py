@@ -1,10 +1,24 @@
+# Imported first: it patches the standard library for gevent workers
+import server
+
 import os
-import json
+import hmac
+import time
 import datetime
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request, make_response
+from flask import Flask, request, make_response, abort
+from cryptography.x509.oid import NameOID
 
+import metrics
+import intermediate
 from logger_client import log
+from missfire_config import getConfig
+from responses import StaticResponse, jsonResponse as nice_json
+from signer import CertSigner, CSRError, REVOCATION_REASONS
+from store import IssuanceStore
 
 
 SERVICE_TYPE = "certificate_authority"
@@ -16,10 +30,68 @@ app = Flask(__name__)
 
 HOST = '0.0.0.0'
 
+config = getConfig()
+
 
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
 
+# Loaded once, see getSigner()
+signer = None
+# Issued certificates and serial numbers, see getStore()
+store = None
+signerLock = threading.RLock()
+
+# 'root' signs with the self-signed root certificate. 'intermediate' has
+# its certificate signed by the root CA at CA_ROOT_URL on start and signs
+# on its own, so that several instances share the load.
+CA_MODE = config.get('CA_MODE', 'root')
+CA_ROOT_URL = config.get('CA_ROOT_URL', 'https://ca:80/')
+# Number of this instance, the root is 0. Instance n issues the serial
+# numbers from n * CA_SERIAL_RANGE on, so instances need no coordination.
+CA_INSTANCE = config.get('CA_INSTANCE', 0)
+CA_SERIAL_RANGE = config.get('CA_SERIAL_RANGE', 2 ** 32)
+# Shared secret that intermediates pass to the root as "token"; unset, the
+# root signs no intermediates
+CA_INTERMEDIATE_SECRET = config.get('CA_INTERMEDIATE_SECRET')
+# Instance numbers the root signs intermediates for, any when empty
+CA_INTERMEDIATES = config.get('CA_INTERMEDIATES', [])
+# Shared secret that callers of /ca/revoke pass as "token"; unset, the
+# route is not served
+CA_REVOCATION_SECRET = config.get('CA_REVOCATION_SECRET')
+# Seconds between checks of the intermediate certificate, and between
+# attempts to renew it, see renewIntermediate()
+RENEWAL_RETRY = 60
+# Signer with the renewed intermediate certificate, swapped in by getSigner()
+renewedSigner = None
+# Process that runs the renewal thread, see startRenewal()
+renewalPid = None
+renewalLock = threading.Lock()
+
+# Largest number of CSRs accepted by /ca/sign/batch
+MAX_BATCH_SIZE = 1000
+# cffi releases the GIL for the duration of OpenSSL calls, so RSA signing
+# in a thread pool runs in parallel on all cores.
+signingPool = ThreadPoolExecutor(max_workers=multiprocessing.cpu_count())
+
+# Seconds a signed CRL is served before it is signed again, see currentCRL()
+CRL_REFRESH = 300
+crlCache = {'last': None, 'signed': 0, 'response': None}
+# The response to /, built on the first request once all routes exist
+routeIndex = None
+
+signLatency = metrics.histogram('ca_sign_seconds',
+                                "Time to sign a CSR, in seconds")
+certsIssued = metrics.counter('ca_certificates_issued_total',
+                              "Certificates issued", ['serviceType'])
+signErrors = metrics.counter('ca_sign_errors_total',
+                             "CSRs not signed", ['reason'])
+batchSizes = metrics.histogram('ca_sign_batch_size',
+                               "CSRs per /ca/sign/batch request",
+                               buckets=(1, 10, 50, 100, 500, 1000))
+revocations = metrics.counter('ca_revocations_total',
+                              "Certificates revoked")
+
 
 def validateTimeStr(timeStr):
     time = None
@@ -42,16 +114,19 @@ def all_links():
         links.append(str(rule))
     return links
 
-def nice_json(arg):
-    """Form JSON responses."""
-    response = make_response(json.dumps(arg, sort_keys = True, indent=4))
-    response.headers['Content-type'] = "application/json"
-    return response
-
-
 @app.route("/", methods=['GET'])
 def hello():
-    return nice_json({"subresource_uris": all_links()})
+    global routeIndex
+    if routeIndex is None:
+        routeIndex = StaticResponse({"subresource_uris": all_links()})
+    return routeIndex.respond()
+
+
+@app.route("/metrics", methods=['GET'])
+def getMetrics():
+    response = make_response(metrics.render())
+    response.headers['Content-type'] = metrics.CONTENT_TYPE
+    return response
 
 
 @app.errorhandler(Exception)
@@ -76,12 +151,8 @@ def genRootCert():
     
     """
 
-    # Create a database index file for the CA
-    open('index.txt', 'a+').close()
-    # Initialize a current serial number file for the CA
-    if not os.path.exists('serial.txt'):
-        with open('serial.txt', 'w') as f: 
-            f.write('01')
+    # Create the database of issued certificates and serial numbers
+    getStore()
     # Generate a new key pair only if it does not exist yet
     if not os.path.exists('cacert.pem') and not os.path.exists('cakey.pem'):
         if os.path.exists('openssl-ca.cnf'):
@@ -95,9 +166,13 @@ def genRootCert():
 @app.route("/ca/reset", methods=['GET'])
 def resetCA():
     """Delete the existent CA"""
+    global signer, store
+    signer = None
+    store = None
+    crlCache['last'] = None
 
     # Get all files of a specific type in the current directory
-    filelist = [ f for f in os.listdir('.') if f.endswith(('.pem', '.txt', '.attr', '.old', '.csr'))]
+    filelist = [ f for f in os.listdir('.') if f.endswith(('.pem', '.txt', '.attr', '.old', '.csr', '.db', '.db-wal', '.db-shm'))]
     for f in filelist:
         os.remove(os.path.join('.', f))
 
@@ -117,14 +192,224 @@ def genServiceCertFromCSR():
     if not validateCSR(csr):
         abort(400)
 
-    fileId = saveToFileCSR(csr)
-    sign(fileId)
-    with open(fileId+'.pem','r') as f:
-        pemData = f.read()
-   
+    try:
+        pemData = signCSR(csr, request.json['serviceType'])
+    except CSRError as e:
+        logger.warning("CSR rejected: %s" % e)
+        abort(400)
+
     return nice_json({"PEM": pemData}), 200
 
 
+@app.route("/ca/sign/batch", methods=['POST'])
+def genServiceCertsFromCSRs():
+    """Sign many CSRs in one request.
+
+    Expects {"token": ..., "requests": [{"serviceType": ..., "csr": ...}]}.
+    Returns {"results": [...]} in the same order; every item holds either
+    the signed "PEM" or an "error" message with its "status" code, so one
+    bad CSR does not fail the whole batch.
+    """
+    if not request.json or not 'token' in request.json or \
+                           not 'requests' in request.json or \
+                           not isinstance(request.json['requests'], list):
+        abort(400)
+
+    token = request.json['token']
+    items = request.json['requests']
+    if not validateToken(token):
+        abort(401)
+    if len(items) > MAX_BATCH_SIZE:
+        abort(413)
+
+    batchSizes.observe(len(items))
+    results = list(signingPool.map(signBatchItem, items))
+    return nice_json({"results": results}), 200
+
+
+def signCSR(csr, serviceType):
+    """Sign a CSR, recording the signing metrics."""
+    try:
+        with signLatency.time():
+            pemData = getSigner().sign(csr, serviceType)
+    except CSRError:
+        signErrors.inc(reason='rejected')
+        raise
+    except Exception:
+        signErrors.inc(reason='failed')
+        raise
+    certsIssued.inc(serviceType=serviceType)
+    return pemData
+
+
+def signBatchItem(item):
+    """Sign a single item of a batch, report errors in the result."""
+    if not isinstance(item, dict) or not 'serviceType' in item or \
+                                     not 'csr' in item:
+        return {"error": "'serviceType' and 'csr' are required", "status": 400}
+    if not validateCSR(item['csr']):
+        return {"error": "CSR rejected", "status": 400}
+    try:
+        return {"PEM": signCSR(item['csr'], item['serviceType'])}
+    except CSRError as e:
+        return {"error": str(e), "status": 400}
+    except Exception as e:
+        logger.error("Batch item signing failed: %s" % e)
+        return {"error": "Internal error", "status": 500}
+
+
+@app.route("/ca/intermediate", methods=['POST'])
+def genIntermediateCert():
+    """Sign the certificate of an intermediate CA instance.
+
+    Expects {"token": CA_INTERMEDIATE_SECRET, "instance": <number>,
+    "csr": ...}, only the root CA signs intermediates. The CSR must carry
+    the common name of that instance.
+    """
+    if CA_MODE != 'root' or not CA_INTERMEDIATE_SECRET:
+        abort(404)
+    if not request.json or not 'token' in request.json or \
+                           not 'instance' in request.json or \
+                           not 'csr' in request.json:
+        abort(400)
+    token = request.json['token']
+    if not isinstance(token, basestring) or \
+       not hmac.compare_digest(toBytes(token),
+                               toBytes(CA_INTERMEDIATE_SECRET)):
+        abort(401)
+    instance = request.json['instance']
+    if not isinstance(instance, int) or instance < 1:
+        abort(400)
+    if CA_INTERMEDIATES and str(instance) not in CA_INTERMEDIATES:
+        logger.warning("Intermediate CA instance %d is not known" % instance)
+        abort(403)
+
+    try:
+        caSigner = getSigner()
+        csr = caSigner.loadCSR(request.json['csr'])
+        names = csr.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+        if [name.value for name in names] != \
+           [intermediate.commonName(caSigner.caCert, instance)]:
+            raise CSRError("Not the common name of instance %d" % instance)
+        pemData = caSigner.signIntermediate(request.json['csr'])
+    except CSRError as e:
+        logger.warning("Intermediate CSR rejected: %s" % e)
+        abort(400)
+    certsIssued.inc(serviceType='intermediate')
+    logger.warning("Intermediate CA certificate issued to instance %d"
+                   % instance)
+    return nice_json({"PEM": pemData}), 200
+
+
+def toBytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+@app.route("/ca/cert/<serial>", methods=['GET'])
+def getCertBySerial(serial):
+    """Look up an issued certificate by its hexadecimal serial number."""
+    try:
+        record = getStore().getBySerial(int(serial, 16))
+    except ValueError:
+        abort(400)
+    if record is None:
+        abort(404)
+    return nice_json(certRecord(record)), 200
+
+
+@app.route("/ca/certs/<serviceType>", methods=['GET'])
+def getCertsByServiceType(serviceType):
+    """List the certificates issued to a service type."""
+    records = getStore().getByServiceType(serviceType)
+    return nice_json({"certs": [certRecord(r) for r in records]}), 200
+
+
+def certRecord(record):
+    return {"serial": "%X" % record['serial'],
+            "serviceType": record['serviceType'],
+            "commonName": record['commonName'],
+            "notAfter": record['notAfter'],
+            "PEM": record['pem']}
+
+
+@app.route("/ca/revoke", methods=['POST'])
+def revokeCert():
+    """Revoke an issued certificate.
+
+    Expects {"token": CA_REVOCATION_SECRET, "serial": <hexadecimal serial>}
+    and optionally a "reason" of RFC 5280, e.g. "keyCompromise".
+    """
+    if not CA_REVOCATION_SECRET:
+        abort(404)
+    if not request.json or not 'token' in request.json or \
+                           not 'serial' in request.json:
+        abort(400)
+    token = request.json['token']
+    if not isinstance(token, basestring) or \
+       not hmac.compare_digest(toBytes(token), toBytes(CA_REVOCATION_SECRET)):
+        abort(401)
+    reason = request.json.get('reason')
+    if reason is not None and reason not in REVOCATION_REASONS:
+        abort(400)
+    try:
+        serial = int(request.json['serial'], 16)
+    except (ValueError, TypeError):
+        abort(400)
+    if getStore().getBySerial(serial) is None:
+        abort(404)
+
+    record = getStore().revoke(serial, datetime.datetime.utcnow(), reason)
+    revocations.inc()
+    logger.warning("Certificate %X revoked" % serial)
+    return nice_json(revocationRecord(record)), 200
+
+
+@app.route("/ca/revoked", methods=['GET'])
+def getRevocations():
+    """Delta feed of revocations.
+
+    Returns the revocations after the one numbered by the 'since' query
+    parameter, and in "last" the number to pass as 'since' next time.
+    """
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        abort(400)
+    records = getStore().getRevocations(since)
+    last = records[-1]['id'] if records else since
+    return nice_json({"revoked": [revocationRecord(r) for r in records],
+                      "last": last}), 200
+
+
+@app.route("/ca/crl", methods=['GET'])
+def getCRL():
+    """CRL of the revoked certificates that have not expired yet."""
+    return currentCRL().respond()
+
+
+def revocationRecord(record):
+    return {"serial": "%X" % record['serial'],
+            "revokedAt": record['revokedAt'],
+            "reason": record['reason']}
+
+
+def currentCRL():
+    """Return the CRL response, signed again after a revocation or
+    CRL_REFRESH."""
+    revocations = getStore().getRevocations()
+    last = revocations[-1]['id'] if revocations else 0
+    with signerLock:
+        if crlCache['last'] != last or \
+           time.time() - crlCache['signed'] > CRL_REFRESH:
+            crlCache['response'] = StaticResponse(
+                {"PEM": getSigner().crl(revocations, int(time.time()))})
+            crlCache['last'] = last
+            crlCache['signed'] = time.time()
+        return crlCache['response']
+
+
 def validateToken(token):
     return True
 
@@ -133,59 +418,118 @@ def validateCSR(csr):
     return True
 
 
-def saveToFileCSR(csr):
-    """Save CSR received from a service"""
-    fileId = datetime.datetime.now().strftime(TIME_FORMAT)
-    with open(fileId+'.csr','w') as f:
-        f.write(csr)
-    return fileId
+def getSigner():
+    """Return the CSR signer, loading the CA key pair on first use.
 
-
-def sign(fileId='servicecert'):
+    A signer with a renewed intermediate certificate replaces the current
+    one here, the renewal itself runs in the background.
     """
-    Create a service certificate.
-
-    Sign service's certificate with the root certificate.
-    openssl-ca.cnf --- a basic CA configuration, input file;
-    servicecert.pem --- a service certificate, output file.
+    global signer, renewedSigner
+    with signerLock:
+        if renewedSigner is not None:
+            signer, renewedSigner = renewedSigner, None
+            crlCache['last'] = None
+        if signer is None:
+            if CA_MODE == 'intermediate':
+                signer = CertSigner(getStore(), intermediate.CERT_FILE,
+                                    intermediate.KEY_FILE)
+            else:
+                signer = CertSigner(getStore(), 'cacert.pem', 'cakey.pem')
+        current = signer
+    if CA_MODE == 'intermediate':
+        startRenewal()
+    return current
+
+
+def startRenewal():
+    """Start renewing the intermediate certificate in a background thread.
+
+    Threads do not survive the fork of the gunicorn workers, so every
+    process starts its own on first use of the signer.
     """
-    if os.path.exists('openssl-ca.cnf'):
-        os.system("openssl ca -batch -config openssl-ca.cnf -policy signing_policy -extensions signing_req -out %s.pem -infiles %s.csr" % (fileId,fileId))
-    else:
-        print "OpenSSL CA configuration file not found"
+    global renewalPid
+    with renewalLock:
+        if renewalPid == os.getpid():
+            return
+        renewalPid = os.getpid()
+    thread = threading.Thread(target=renewalLoop, name='IntermediateRenewal')
+    thread.daemon = True
+    thread.start()
+
 
+def renewalLoop():
+    while True:
+        time.sleep(RENEWAL_RETRY)
+        renewIntermediate()
 
-def isDocker():
-    """Determines if we are running inside Docker.
 
-    The process's PID inside the container differs from it's PID on the host
-    (a non-container system).
+def renewIntermediate():
+    """Have the root sign a new intermediate certificate if it is due.
+
+    Requests keep signing with the current certificate meanwhile, which
+    is still valid for the service certificates' lifetime. Failures are
+    retried after RENEWAL_RETRY seconds.
     """
-    procList = ""
-    if os.path.isfile('/proc/1/cgroup'):
-        with open('/proc/1/cgroup', 'rt') as f:
-            procList = f.read()
-    procList = procList.decode('utf-8').lower()
-    checks = [
-        'docker' in procList,
-        '/lxc/' in procList,
-        procList and procList.split()[0] not in ('systemd', 'init',),
-        os.path.exists('/.dockerenv'),
-        os.path.exists('/.dockerinit'),
-        os.getenv('container', None) is not None
-    ]
-    return any(checks)
-    
+    global renewedSigner
+    current = renewedSigner or signer
+    timeLeft = current.caCert.not_valid_after - datetime.datetime.utcnow()
+    if timeLeft >= intermediate.MIN_VALIDITY:
+        return
+    try:
+        intermediate.setup(CA_ROOT_URL, CA_INSTANCE, logger,
+                           CA_INTERMEDIATE_SECRET, attempts=1)
+        renewedSigner = CertSigner(getStore(), intermediate.CERT_FILE,
+                                   intermediate.KEY_FILE)
+        logger.info("Intermediate CA certificate renewed")
+    except Exception as e:
+        logger.error("Intermediate CA certificate not renewed: %s" % e)
+
+
+def getStore():
+    """Return the issuance store, opening the database on first use."""
+    global store
+    with signerLock:
+        if store is None:
+            # The serial number range of this instance, 0 is never used
+            firstSerial = max(1, CA_INSTANCE * CA_SERIAL_RANGE)
+            lastSerial = (CA_INSTANCE + 1) * CA_SERIAL_RANGE - 1
+            store = IssuanceStore('ca.db', firstSerial, lastSerial)
+        return store
+
 
 def main():
-    if isDocker():
+    if config.isDocker():
         FLASK_PORT = 80
     else:
-        FLASK_PORT = 8080
-    # Setup the self-hosted CA
-    genRootCert()
-    # Order matters!
-    context = ('cacert.pem', 'cakey.pem')
+        # Intermediate instance n listens on 8090 + n, next to the root
+        # and the reverse STS
+        FLASK_PORT = 8090 + CA_INSTANCE if CA_INSTANCE else 8080
+    # Not CA_PORT: clients read that one to reach the root, and a shared
+    # configuration would make every instance bind the root's port
+    FLASK_PORT = config.get('CA_LISTEN_PORT', FLASK_PORT)
+    if CA_MODE == 'intermediate':
+        if CA_INSTANCE < 1:
+            raise ValueError("An intermediate CA needs a CA_INSTANCE "
+                             "of 1 or more")
+        if not CA_INTERMEDIATE_SECRET:
+            raise ValueError("An intermediate CA needs the root's "
+                             "CA_INTERMEDIATE_SECRET")
+        # Get the intermediate certificate signed by the root
+        getStore()
+        intermediate.setup(CA_ROOT_URL, CA_INSTANCE, logger,
+                           CA_INTERMEDIATE_SECRET)
+        # Order matters!
+        context = (intermediate.CHAIN_FILE, intermediate.KEY_FILE)
+    else:
+        # Setup the self-hosted CA
+        genRootCert()
+        # Order matters!
+        context = ('cacert.pem', 'cakey.pem')
+    getSigner()
+    if server.SERVER_MODE == 'production':
+        # The CA key is loaded, and shared by the workers
+        server.runProduction(app, HOST, FLASK_PORT, *context)
+        return
     # Start Flask web server
     app.run(port=FLASK_PORT, debug=True, host=HOST, ssl_context=context)
 
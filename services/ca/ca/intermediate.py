@@ -0,0 +1,188 @@
+"""Intermediate CA instances.
+
+An instance started with CA_MODE=intermediate has a certificate of its own
+signed by the root CA, and then signs service CSRs without the root.
+Issued certificates carry the intermediate certificate, so services that
+trust the root (cacert.pem) verify them as before.
+
+cacert.pem           --- the root CA certificate, trusted;
+intermediatekey.pem  --- the private key of this instance;
+intermediatecert.pem --- its certificate, signed by the root;
+cachain.pem          --- both certificates, served over TLS.
+"""
+import os
+import ssl
+import time
+import fcntl
+import urlparse
+import datetime
+
+import requests
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, padding
+
+from signer import DEFAULT_DAYS
+
+
+ROOT_CERT_FILE = 'cacert.pem'
+KEY_FILE = 'intermediatekey.pem'
+CERT_FILE = 'intermediatecert.pem'
+CHAIN_FILE = 'cachain.pem'
+# Held by the process that replaces the files above
+LOCK_FILE = 'intermediate.lock'
+# A certificate with less time left is replaced, on start and at runtime.
+# It must outlive the service certificates it signs, with a day to spare
+# for reaching the root.
+MIN_VALIDITY = datetime.timedelta(days=2 * DEFAULT_DAYS)
+# Attempts to reach the root CA on start, two seconds apart
+ROOT_ATTEMPTS = 30
+
+
+def readAltNames(configFile):
+    """DNS names of the [ alternate_names ] section of an OpenSSL config."""
+    names = []
+    section = None
+    with open(configFile, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line.startswith('['):
+                section = line.strip('[] ')
+            elif section == 'alternate_names' and line.startswith('DNS.'):
+                names.append(line.split('=', 1)[1].strip())
+    return names
+
+
+def isSignedBy(cert, issuer):
+    """True if issuer's key made the signature of cert."""
+    if cert.issuer != issuer.subject:
+        return False
+    pubKey = issuer.public_key()
+    try:
+        if isinstance(pubKey, rsa.RSAPublicKey):
+            pubKey.verify(cert.signature, cert.tbs_certificate_bytes,
+                          padding.PKCS1v15(), cert.signature_hash_algorithm)
+        elif isinstance(pubKey, ec.EllipticCurvePublicKey):
+            pubKey.verify(cert.signature, cert.tbs_certificate_bytes,
+                          ec.ECDSA(cert.signature_hash_algorithm))
+        else:
+            return False
+    except InvalidSignature:
+        return False
+    return True
+
+
+def loadRootCert(rootUrl, logger):
+    """The root CA certificate, fetched from the root when missing."""
+    if not os.path.exists(ROOT_CERT_FILE):
+        logger.warning("UNSAFE: Retrieving remote root CA certificate")
+        url = urlparse.urlsplit(rootUrl)
+        for attempt in range(ROOT_ATTEMPTS):
+            try:
+                pem = ssl.get_server_certificate((url.hostname,
+                                                  url.port or 443))
+                break
+            except IOError as e:
+                logger.warning("Root CA unavailable: %s" % e)
+                time.sleep(2)
+        else:
+            raise RuntimeError("Root CA certificate not retrieved")
+        with open(ROOT_CERT_FILE, 'w') as f:
+            f.write(pem)
+    with open(ROOT_CERT_FILE, 'rb') as f:
+        return x509.load_pem_x509_certificate(f.read(), default_backend())
+
+
+def isUsable(rootCert):
+    """True if the stored key and certificate can keep serving."""
+    if not os.path.exists(KEY_FILE) or not os.path.exists(CERT_FILE):
+        return False
+    backend = default_backend()
+    with open(CERT_FILE, 'rb') as f:
+        cert = x509.load_pem_x509_certificate(f.read(), backend)
+    with open(KEY_FILE, 'rb') as f:
+        key = serialization.load_pem_private_key(f.read(), None, backend)
+    samePublicKey = cert.public_key().public_numbers() == \
+                    key.public_key().public_numbers()
+    timeLeft = cert.not_valid_after - datetime.datetime.utcnow()
+    return samePublicKey and isSignedBy(cert, rootCert) and \
+           timeLeft > MIN_VALIDITY
+
+
+def commonName(rootCert, instance):
+    """The CN of instance, named after the root."""
+    return u'%s intermediate %d' % (
+        rootCert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value,
+        instance)
+
+
+def genCSR(key, rootCert, instance, configFile='openssl-ca.cnf'):
+    """CSR of instance, named after the root and valid for its host names."""
+    subject = [attribute for attribute in rootCert.subject
+               if attribute.oid not in (NameOID.COMMON_NAME,
+                                        NameOID.EMAIL_ADDRESS)]
+    subject.append(x509.NameAttribute(NameOID.COMMON_NAME,
+                                      commonName(rootCert, instance)))
+    altNames = readAltNames(configFile) + ['ca-%d' % instance]
+    return x509.CertificateSigningRequestBuilder() \
+        .subject_name(x509.Name(subject)) \
+        .add_extension(x509.SubjectAlternativeName(
+            [x509.DNSName(u'%s' % name) for name in altNames]),
+            critical=False) \
+        .sign(key, hashes.SHA256(), default_backend())
+
+
+def writeFile(name, data, mode=0o644):
+    """Replace file name at once, readers never see it half written."""
+    fd = os.open(name + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(name + '.tmp', name)
+
+
+def setup(rootUrl, instance, logger, token, attempts=ROOT_ATTEMPTS):
+    """Make sure this instance has a usable intermediate certificate.
+
+    Otherwise a new key is generated and its CSR is signed by the root CA
+    at rootUrl, which expects token, its CA_INTERMEDIATE_SECRET. Workers
+    of one instance take turns, the first one replaces the files and the
+    others find them usable.
+    """
+    rootCert = loadRootCert(rootUrl, logger)
+    with open(LOCK_FILE, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if isUsable(rootCert):
+            logger.info("Intermediate CA certificate already exists")
+            return
+        key = rsa.generate_private_key(65537, 4096, default_backend())
+        csr = genCSR(key, rootCert, instance)
+        payload = {'token': token, 'instance': instance,
+                   'csr': csr.public_bytes(serialization.Encoding.PEM)}
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(2)
+            try:
+                res = requests.post(rootUrl + 'ca/intermediate', json=payload,
+                                    verify=ROOT_CERT_FILE, timeout=30)
+                if res.status_code == requests.codes.ok:
+                    break
+                logger.warning("Intermediate CA certificate not signed, "
+                               "status code %s" % res.status_code)
+            except requests.exceptions.ConnectionError as e:
+                logger.warning("Root CA unavailable: %s" % e)
+        else:
+            raise RuntimeError("Intermediate CA certificate not signed")
+
+        certPem = res.json()['PEM']
+        with open(ROOT_CERT_FILE, 'r') as f:
+            rootPem = f.read()
+        writeFile(KEY_FILE, key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()), 0o600)
+        writeFile(CERT_FILE, certPem)
+        writeFile(CHAIN_FILE, certPem + rootPem)
+    logger.info("Intermediate CA certificate %d signed by the root" % instance)
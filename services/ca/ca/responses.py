@@ -0,0 +1,58 @@
+"""JSON responses of the infrastructure APIs.
+
+Bodies are compact JSON unless JSON_PRETTY is set. Responses that change
+rarely, e.g. the route index or a published certificate, are encoded
+once into a StaticResponse and served with an ETag: a client that sends
+it back in If-None-Match gets an empty 304 while nothing changed.
+"""
+import json
+import hashlib
+
+from flask import request, make_response
+
+from missfire_config import getConfig
+
+
+# Indent and sort JSON responses, for reading them by hand
+JSON_PRETTY = getConfig().get('JSON_PRETTY', False)
+
+CONTENT_TYPE = 'application/json'
+
+
+def encode(arg):
+    if JSON_PRETTY:
+        return json.dumps(arg, sort_keys=True, indent=4)
+    return json.dumps(arg, separators=(',', ':'))
+
+
+def jsonResponse(arg):
+    """Form a JSON response."""
+    response = make_response(encode(arg))
+    response.headers['Content-type'] = CONTENT_TYPE
+    return response
+
+
+class StaticResponse():
+    """A JSON body encoded once, served with an ETag."""
+    def __init__(self, arg):
+        self.body = encode(arg)
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()
+
+    def isCurrent(self):
+        """True if the client of the request holds this body already."""
+        tags = request.headers.get('If-None-Match')
+        if not tags:
+            return False
+        return tags.strip() == '*' or \
+               self.etag in [tag.strip() for tag in tags.split(',')]
+
+    def respond(self):
+        if self.isCurrent():
+            response = make_response('', 304)
+        else:
+            response = make_response(self.body)
+            response.headers['Content-type'] = CONTENT_TYPE
+        response.headers['ETag'] = self.etag
+        # May be stored, but must be revalidated before use
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
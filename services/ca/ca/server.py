@@ -0,0 +1,74 @@
+"""Serving of the MiSSFire infrastructure services.
+
+In production mode the app is served by gunicorn. The app, and with it
+the keys and the configuration, is loaded once by the master process and
+shared copy-on-write by the forked workers.
+
+Graceful reload: SIGHUP to the master starts new workers with the
+current settings and stops the old ones once their requests are done.
+The preloaded app is kept, to load new code send SIGUSR2 to start a new
+master next to the old one and then SIGTERM to the old one.
+"""
+import multiprocessing
+
+from missfire_config import getConfig
+
+config = getConfig()
+
+# 'development' runs Flask's debug server, 'production' runs gunicorn
+SERVER_MODE = config.get('SERVER_MODE', 'development')
+# Number of gunicorn worker processes in production mode
+SERVER_WORKERS = config.get('SERVER_WORKERS', multiprocessing.cpu_count())
+# gunicorn worker class: 'sync', 'gthread' or 'gevent'
+SERVER_WORKER_CLASS = config.get('SERVER_WORKER_CLASS', 'sync')
+# Threads per worker of the 'gthread' class
+SERVER_THREADS = config.get('SERVER_THREADS', 1)
+# Connections served at once per worker of the 'gevent' class
+SERVER_WORKER_CONNECTIONS = config.get('SERVER_WORKER_CONNECTIONS', 1000)
+# Seconds a worker may hang before it is restarted
+SERVER_TIMEOUT = config.get('SERVER_TIMEOUT', 30)
+# Seconds workers get to finish their requests on reload or shutdown
+SERVER_GRACEFUL_TIMEOUT = config.get('SERVER_GRACEFUL_TIMEOUT', 30)
+# Seconds to wait for the next request on a kept-alive connection
+SERVER_KEEPALIVE = config.get('SERVER_KEEPALIVE', 5)
+# Requests after which a worker is replaced, 0 never
+SERVER_MAX_REQUESTS = config.get('SERVER_MAX_REQUESTS', 0)
+# File with the PID of the master, the target of the reload signals
+SERVER_PIDFILE = config.get('SERVER_PIDFILE')
+
+if SERVER_MODE == 'production' and SERVER_WORKER_CLASS == 'gevent':
+    # Must happen before the app creates its locks, threads and sockets,
+    # so this module is imported first.
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def runProduction(app, host, port, certFile=None, keyFile=None):
+    """Serve app with gunicorn until the master is stopped."""
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', '%s:%s' % (host, port))
+            self.cfg.set('workers', SERVER_WORKERS)
+            self.cfg.set('worker_class', SERVER_WORKER_CLASS)
+            self.cfg.set('threads', SERVER_THREADS)
+            self.cfg.set('worker_connections', SERVER_WORKER_CONNECTIONS)
+            self.cfg.set('timeout', SERVER_TIMEOUT)
+            self.cfg.set('graceful_timeout', SERVER_GRACEFUL_TIMEOUT)
+            self.cfg.set('keepalive', SERVER_KEEPALIVE)
+            if SERVER_MAX_REQUESTS:
+                self.cfg.set('max_requests', SERVER_MAX_REQUESTS)
+                # Workers started together are not replaced together
+                self.cfg.set('max_requests_jitter', SERVER_MAX_REQUESTS // 10)
+            if SERVER_PIDFILE:
+                self.cfg.set('pidfile', SERVER_PIDFILE)
+            if certFile:
+                self.cfg.set('certfile', certFile)
+                self.cfg.set('keyfile', keyFile)
+            self.cfg.set('preload_app', True)
+
+        def load(self):
+            return app
+
+    Server().run()
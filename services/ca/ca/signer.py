@@ -0,0 +1,216 @@
+import datetime
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+
+
+# [ CA_default ] section of openssl-ca.cnf
+DEFAULT_DAYS = 1
+# Lifetime of an intermediate CA certificate, bounded by the root's
+INTERMEDIATE_DAYS = 30
+# Time until the next update announced in a CRL
+CRL_VALIDITY = datetime.timedelta(hours=1)
+# Revocation reasons of RFC 5280, e.g. 'keyCompromise'
+REVOCATION_REASONS = set(reason.value for reason in x509.ReasonFlags)
+
+# [ signing_policy ] section of openssl-ca.cnf. With 'preserve = no' the
+# subject of an issued certificate is rebuilt in this order and attributes
+# that are not listed are dropped. 'email_in_dn = no' removes emailAddress.
+SIGNING_POLICY = [
+    (NameOID.COUNTRY_NAME, 'optional'),
+    (NameOID.STATE_OR_PROVINCE_NAME, 'optional'),
+    (NameOID.LOCALITY_NAME, 'optional'),
+    (NameOID.ORGANIZATION_NAME, 'optional'),
+    (NameOID.ORGANIZATIONAL_UNIT_NAME, 'optional'),
+    (NameOID.COMMON_NAME, 'supplied'),
+]
+
+# Short names used in policy error messages
+SHORT_NAMES = {
+    NameOID.COUNTRY_NAME: 'C',
+    NameOID.STATE_OR_PROVINCE_NAME: 'ST',
+    NameOID.LOCALITY_NAME: 'L',
+    NameOID.ORGANIZATION_NAME: 'O',
+    NameOID.ORGANIZATIONAL_UNIT_NAME: 'OU',
+    NameOID.COMMON_NAME: 'CN',
+}
+
+
+class CSRError(ValueError):
+    """The CSR cannot be parsed or does not satisfy the signing policy."""
+
+
+def parseTime(value):
+    """Parse a time stored by IssuanceStore, i.e. written by isoformat()."""
+    if '.' in value:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+class CertSigner():
+    """Signs service CSRs with the CA key held in memory.
+
+    Replaces 'openssl ca -batch -policy signing_policy -extensions signing_req'.
+    The CA key and certificate are loaded once; every CSR is parsed, checked
+    and signed in memory. Serial numbers are allocated by, and issued
+    certificates recorded in, an IssuanceStore.
+
+    The CA certificate is either the self-signed root or an intermediate
+    signed by the root. An intermediate appends its own certificate to the
+    certificates it issues, so that peers trusting the root can verify them.
+    """
+    def __init__(self, store, caCertFile='cacert.pem', caKeyFile='cakey.pem',
+                 days=DEFAULT_DAYS):
+        self.store = store
+        self.caCertFile = caCertFile
+        self.caKeyFile = caKeyFile
+        self.days = days
+        self.backend = default_backend()
+
+        with open(self.caCertFile, 'rb') as f:
+            self.caCert = x509.load_pem_x509_certificate(f.read(), self.backend)
+        with open(self.caKeyFile, 'rb') as f:
+            self.caKey = serialization.load_pem_private_key(f.read(), None,
+                                                            self.backend)
+        self.authorityKeyId = self._authorityKeyId()
+        self.chain = ''
+        if self.caCert.issuer != self.caCert.subject:
+            self.chain = self.caCert.public_bytes(
+                serialization.Encoding.PEM).decode('ascii')
+
+    def _authorityKeyId(self):
+        """authorityKeyIdentifier = keyid,issuer"""
+        try:
+            ski = self.caCert.extensions.get_extension_for_class(
+                x509.SubjectKeyIdentifier)
+            return x509.AuthorityKeyIdentifier(ski.value.digest, None, None)
+        except x509.ExtensionNotFound:
+            return x509.AuthorityKeyIdentifier.from_issuer_public_key(
+                self.caKey.public_key())
+
+    def loadCSR(self, csrPem):
+        """Parse a PEM encoded CSR and check its self-signature."""
+        if not isinstance(csrPem, bytes):
+            csrPem = csrPem.encode('ascii')
+        try:
+            csr = x509.load_pem_x509_csr(csrPem, self.backend)
+        except ValueError as e:
+            raise CSRError("Malformed CSR: %s" % e)
+        if not csr.is_signature_valid:
+            raise CSRError("CSR signature is invalid")
+        return csr
+
+    def applyPolicy(self, csr):
+        """Build the certificate subject according to signing_policy."""
+        attributes = []
+        for oid, rule in SIGNING_POLICY:
+            values = csr.subject.get_attributes_for_oid(oid)
+            if rule == 'supplied' and not values:
+                raise CSRError("The %s field needed to be supplied"
+                               % SHORT_NAMES[oid])
+            attributes.extend(values)
+        return x509.Name(attributes)
+
+    def sign(self, csrPem, serviceType=None):
+        """Sign a PEM encoded CSR, return a PEM encoded certificate.
+
+        Issued by an intermediate, the PEM holds the intermediate too.
+        """
+        csr = self.loadCSR(csrPem)
+        # [ signing_req ] section of openssl-ca.cnf
+        extensions = [
+            (x509.BasicConstraints(ca=False, path_length=None), False),
+            (x509.KeyUsage(digital_signature=True, content_commitment=False,
+                           key_encipherment=True, data_encipherment=False,
+                           key_agreement=False, key_cert_sign=False,
+                           crl_sign=False, encipher_only=False,
+                           decipher_only=False), False),
+        ]
+        return self.issue(csr, serviceType, self.days, extensions) + self.chain
+
+    def signIntermediate(self, csrPem, days=INTERMEDIATE_DAYS):
+        """Sign the CSR of an intermediate CA, return its PEM certificate.
+
+        The intermediate may sign service certificates but no further CAs,
+        and it serves TLS with this certificate too.
+        """
+        csr = self.loadCSR(csrPem)
+        extensions = [
+            (x509.BasicConstraints(ca=True, path_length=0), True),
+            (x509.KeyUsage(digital_signature=True, content_commitment=False,
+                           key_encipherment=False, data_encipherment=False,
+                           key_agreement=False, key_cert_sign=True,
+                           crl_sign=True, encipher_only=False,
+                           decipher_only=False), True),
+        ]
+        return self.issue(csr, 'intermediate', days, extensions)
+
+    def issue(self, csr, serviceType, days, extensions):
+        """Sign a checked CSR with the given extensions and record it.
+
+        The certificate does not outlive the CA certificate.
+        """
+        subject = self.applyPolicy(csr)
+        notBefore = datetime.datetime.utcnow()
+        notAfter = min(notBefore + datetime.timedelta(days=days),
+                       self.caCert.not_valid_after)
+        serial = self.store.nextSerial()
+
+        builder = x509.CertificateBuilder() \
+            .subject_name(subject) \
+            .issuer_name(self.caCert.subject) \
+            .public_key(csr.public_key()) \
+            .serial_number(serial) \
+            .not_valid_before(notBefore) \
+            .not_valid_after(notAfter)
+
+        extensions = [
+            (x509.SubjectKeyIdentifier.from_public_key(csr.public_key()), False),
+            (self.authorityKeyId, False),
+        ] + extensions
+        # 'copy_extensions = copy': take the remaining extensions, such as
+        # subjectAltName, from the CSR. Extensions unknown to cryptography
+        # (e.g. nsComment) cannot be re-encoded and are skipped.
+        present = set(type(ext) for ext, _ in extensions)
+        for ext in csr.extensions:
+            if isinstance(ext.value, x509.UnrecognizedExtension):
+                continue
+            if type(ext.value) not in present:
+                extensions.append((ext.value, ext.critical))
+
+        for ext, critical in extensions:
+            builder = builder.add_extension(ext, critical=critical)
+
+        cert = builder.sign(self.caKey, hashes.SHA256(), self.backend)
+        pem = cert.public_bytes(serialization.Encoding.PEM).decode('ascii')
+        commonName = subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
+        self.store.add(serial, serviceType, commonName, notAfter, pem)
+        return pem
+
+    def crl(self, revocations, number):
+        """Sign a PEM encoded CRL of the given revocation records.
+
+        Revoked certificates that have expired are left out, which keeps
+        the CRL as short as the certificate lifetime allows.
+        """
+        now = datetime.datetime.utcnow()
+        builder = x509.CertificateRevocationListBuilder() \
+            .issuer_name(self.caCert.subject) \
+            .last_update(now) \
+            .next_update(now + CRL_VALIDITY) \
+            .add_extension(self.authorityKeyId, critical=False) \
+            .add_extension(x509.CRLNumber(number), critical=False)
+        for record in revocations:
+            if record['notAfter'] and parseTime(record['notAfter']) < now:
+                continue
+            entry = x509.RevokedCertificateBuilder() \
+                .serial_number(record['serial']) \
+                .revocation_date(parseTime(record['revokedAt']))
+            if record['reason']:
+                reason = x509.CRLReason(x509.ReasonFlags(record['reason']))
+                entry = entry.add_extension(reason, critical=False)
+            builder = builder.add_revoked_certificate(entry.build(self.backend))
+        crl = builder.sign(self.caKey, hashes.SHA256(), self.backend)
+        return crl.public_bytes(serialization.Encoding.PEM).decode('ascii')
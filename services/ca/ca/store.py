@@ -0,0 +1,223 @@
+import os
+import time
+import sqlite3
+import datetime
+import threading
+
+
+# Serial numbers reserved from the database at once by a process
+SERIAL_BLOCK_SIZE = 64
+# Seconds between two sweeps of expired certificates out of memory
+PRUNE_INTERVAL = 60
+
+
+def utcnow():
+    # Written by isoformat() like notAfter, the strings sort by time
+    return datetime.datetime.utcnow().isoformat()
+
+
+def isExpired(record, now):
+    return record['notAfter'] is not None and record['notAfter'] <= now
+
+
+class IssuanceStore():
+    """Record of issued certificates, shared by all CA worker processes.
+
+    Replaces serial.txt and index.txt of 'openssl ca'. Serial numbers are
+    reserved in blocks with a single write transaction, so concurrent
+    workers never hand out the same serial and only touch the database
+    once per SERIAL_BLOCK_SIZE certificates. Issued certificates are
+    appended to an SQLite database in WAL mode and indexed in memory by
+    serial, subject CN and service type. Records written by other workers
+    are picked up incrementally: by a lookup by serial when it misses, by
+    the other lookups every time, since their records may have changed.
+    Only certificates that have not expired are kept in memory; lookups by
+    serial fall back to the database for the others.
+
+    Revocations are numbered in the order they happen, which lets clients
+    fetch only those newer than the last one they know.
+
+    Serial numbers are taken from firstSerial up to lastSerial. CA
+    instances given disjoint ranges issue unique serials without sharing
+    a database.
+    """
+    def __init__(self, dbFile='ca.db', firstSerial=1, lastSerial=None):
+        self.dbFile = dbFile
+        self.firstSerial = firstSerial
+        self.lastSerial = lastSerial
+        self.lock = threading.Lock()
+        self.pid = None
+        self.conn = None
+        self._reset()
+
+    def _reset(self):
+        """Forget per-process state, e.g. after a fork."""
+        self.serials = iter(())
+        self.lastRowId = 0
+        self.pruned = time.time()
+        self.bySerial = {}
+        self.byCommonName = {}
+        self.byServiceType = {}
+
+    def _connect(self):
+        """Return a connection owned by the current process."""
+        if self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.dbFile, timeout=30,
+                                        check_same_thread=False,
+                                        isolation_level=None)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS serial "
+                              "(next INTEGER NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS certificates ("
+                              "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                              "serial INTEGER UNIQUE NOT NULL, "
+                              "serviceType TEXT, "
+                              "commonName TEXT, "
+                              "notAfter TEXT, "
+                              "pem TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS revocations ("
+                              "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                              "serial INTEGER UNIQUE NOT NULL, "
+                              "revokedAt TEXT, "
+                              "reason TEXT)")
+            self.pid = os.getpid()
+            self._reset()
+        return self.conn
+
+    def _reserveBlock(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT next FROM serial").fetchone()
+            # The range may have moved, e.g. to another instance number
+            start = self.firstSerial if row is None else \
+                    max(row['next'], self.firstSerial)
+            end = start + SERIAL_BLOCK_SIZE
+            if self.lastSerial is not None:
+                if start > self.lastSerial:
+                    raise RuntimeError("Serial number range exhausted")
+                end = min(end, self.lastSerial + 1)
+            if row is None:
+                conn.execute("INSERT INTO serial (next) VALUES (?)", (end,))
+            else:
+                conn.execute("UPDATE serial SET next = ?", (end,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.serials = iter(range(start, end))
+
+    def nextSerial(self):
+        """Allocate a serial number that is unique across all workers."""
+        with self.lock:
+            conn = self._connect()
+            serial = next(self.serials, None)
+            if serial is None:
+                self._reserveBlock(conn)
+                serial = next(self.serials)
+            return serial
+
+    def add(self, serial, serviceType, commonName, notAfter, pem):
+        """Record an issued certificate."""
+        with self.lock:
+            conn = self._connect()
+            conn.execute("INSERT INTO certificates "
+                         "(serial, serviceType, commonName, notAfter, pem) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         (serial, serviceType, commonName,
+                          notAfter.isoformat(), pem))
+        self.refresh()
+
+    def refresh(self):
+        """Load the records appended since the last refresh."""
+        now = utcnow()
+        with self.lock:
+            conn = self._connect()
+            rows = conn.execute("SELECT * FROM certificates WHERE id > ? "
+                                "ORDER BY id", (self.lastRowId,)).fetchall()
+            for row in rows:
+                record = dict(row)
+                self.lastRowId = record['id']
+                if isExpired(record, now):
+                    continue
+                self.bySerial[record['serial']] = record
+                self.byCommonName[record['commonName']] = record
+                self.byServiceType.setdefault(record['serviceType'],
+                                              []).append(record)
+            if time.time() - self.pruned > PRUNE_INTERVAL:
+                self._prune(now)
+
+    def _prune(self, now):
+        """Drop the expired records from the indexes."""
+        for serial, record in self.bySerial.items():
+            if isExpired(record, now):
+                del self.bySerial[serial]
+        for commonName, record in self.byCommonName.items():
+            if isExpired(record, now):
+                del self.byCommonName[commonName]
+        for serviceType, records in self.byServiceType.items():
+            records = [r for r in records if not isExpired(r, now)]
+            if records:
+                self.byServiceType[serviceType] = records
+            else:
+                del self.byServiceType[serviceType]
+        self.pruned = time.time()
+
+    def _lookup(self, indexName, key, always=False):
+        # By name: the first connection of a process replaces the indexes
+        if always or key not in getattr(self, indexName):
+            self.refresh()
+        now = utcnow()
+        with self.lock:
+            value = getattr(self, indexName).get(key)
+            # Expired since the last sweep
+            if isinstance(value, list):
+                return [r for r in value if not isExpired(r, now)]
+            return None if value is None or isExpired(value, now) else value
+
+    def getBySerial(self, serial):
+        """The record of serial, also once the certificate has expired."""
+        # A serial is issued once, a record found is up to date
+        record = self._lookup('bySerial', serial)
+        if record is None:
+            with self.lock:
+                row = self._connect().execute(
+                    "SELECT * FROM certificates WHERE serial = ?",
+                    (serial,)).fetchone()
+                record = dict(row) if row else None
+        return record
+
+    def getByCommonName(self, commonName):
+        return self._lookup('byCommonName', commonName, always=True)
+
+    def getByServiceType(self, serviceType):
+        """The certificates of serviceType that have not expired."""
+        return self._lookup('byServiceType', serviceType, always=True) or []
+
+    def revoke(self, serial, revokedAt, reason=None):
+        """Record the revocation of a certificate, return the record.
+
+        Revoking a certificate again keeps the first record.
+        """
+        with self.lock:
+            conn = self._connect()
+            conn.execute("INSERT OR IGNORE INTO revocations "
+                         "(serial, revokedAt, reason) VALUES (?, ?, ?)",
+                         (serial, revokedAt.isoformat(), reason))
+            row = conn.execute("SELECT * FROM revocations WHERE serial = ?",
+                               (serial,)).fetchone()
+            return dict(row)
+
+    def getRevocations(self, since=0):
+        """Revocations recorded after the one numbered since, oldest first.
+
+        Each record also holds the notAfter of the revoked certificate.
+        """
+        with self.lock:
+            conn = self._connect()
+            rows = conn.execute("SELECT r.*, c.notAfter FROM revocations r "
+                                "LEFT JOIN certificates c USING (serial) "
+                                "WHERE r.id > ? ORDER BY r.id",
+                                (since,)).fetchall()
+            return [dict(row) for row in rows]
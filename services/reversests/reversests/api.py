@@ -1,11 +1,27 @@
+# Imported first: it patches the standard library for gevent workers
+import server
+
 import os
-import json
+import hmac
+import time
+import uuid
+import base64
+import shutil
 import datetime
+import threading
 
+import jwt
 from flask import Flask, request, make_response, abort
-from flask_jwt_extended import JWTManager, create_access_token
+from cryptography.x509 import load_pem_x509_certificate
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
 
+import metrics
 from logger_client import log
+from missfire_config import getConfig
+from jwk import publicJwk, thumbprint
+from responses import StaticResponse, jsonResponse as nice_json
 
 
 SERVICE_TYPE = "reversests"
@@ -17,6 +33,44 @@ app = Flask(__name__)
 
 HOST = '0.0.0.0'
 
+config = getConfig()
+
+# Token signing algorithm, the key type of the service certificate follows
+JWT_ALGORITHM = config.get('JWT_ALGORITHM', 'RS256')
+# openssl req -newkey arguments per algorithm family
+KEY_ALGORITHMS = {
+    'RS': 'rsa:2048',
+    'PS': 'rsa:2048',
+    'ES256': 'ec -pkeyopt ec_paramgen_curve:prime256v1',
+    'ES384': 'ec -pkeyopt ec_paramgen_curve:secp384r1',
+    'ES512': 'ec -pkeyopt ec_paramgen_curve:secp521r1',
+}
+# Lifetime of issued tokens
+JWT_ACCESS_TOKEN_EXPIRES = datetime.timedelta(seconds=60*10)
+# Shared secret that callers of /cert/rotate pass as "token"; unset, the
+# route is not served
+KEY_ROTATION_SECRET = config.get('KEY_ROTATION_SECRET')
+# Seconds the /cert/jwks response is served before it is built again,
+# dropping the retired keys that expired meanwhile
+KEY_SET_REFRESH = 60
+# Largest number of tokens issued by one /login/batch request
+MAX_BATCH_SIZE = 1000
+# OpenSSL curve names to the names used by cryptography
+EC_CURVES = {
+    'prime256v1': 'secp256r1',
+    'secp384r1': 'secp384r1',
+    'secp521r1': 'secp521r1',
+}
+
+tokensIssued = metrics.counter('sts_tokens_issued_total', "Access tokens issued")
+issueLatency = metrics.histogram('sts_issue_seconds',
+                                 "Time to issue an access token, in seconds")
+batchSizes = metrics.histogram('sts_login_batch_size',
+                               "Tokens per /login/batch request",
+                               buckets=(1, 10, 50, 100, 500, 1000))
+
+# The response to /, built on the first request once all routes exist
+routeIndex = None
 
 
 #####################################################################
@@ -30,7 +84,10 @@ def all_links():
 
 @app.route("/", methods=['GET'])
 def hello():
-    return nice_json({"subresource_uris": all_links()})
+    global routeIndex
+    if routeIndex is None:
+        routeIndex = StaticResponse({"subresource_uris": all_links()})
+    return routeIndex.respond()
 
 
 @app.route('/login', methods=['POST'])
@@ -39,15 +96,72 @@ def login():
         abort(400)
     username = request.json['username']
     # Identity can be any data that is json serializable
-    access_token = create_access_token(identity=username)
-    print "JWT issued for '%s'" % username
+    access_token = tokenIssuer.issue(username)
+    logger.info("JWT issued for '%s'" % username)
 
     return nice_json({'access_token': access_token}), 200
 
 
+@app.route('/login/batch', methods=['POST'])
+def loginBatch():
+    """Issue tokens for many users in one request.
+
+    Expects {"usernames": [...]}, returns {"access_tokens": [...]} in the
+    same order.
+    """
+    if not request.json or not 'usernames' in request.json or \
+       not isinstance(request.json['usernames'], list):
+        abort(400)
+    usernames = request.json['usernames']
+    if len(usernames) > MAX_BATCH_SIZE:
+        abort(413)
+    batchSizes.observe(len(usernames))
+    access_tokens = [tokenIssuer.issue(username) for username in usernames]
+    logger.info("%d JWTs issued in a batch" % len(access_tokens))
+
+    return nice_json({'access_tokens': access_tokens}), 200
+
+
 @app.route("/cert/pem", methods=['GET'])
 def getTokenCert():
-    return nice_json({'PEM': certMng.getCert()}), 200
+    certMng.refresh()
+    return certMng.published.respond()
+
+
+@app.route("/cert/jwks", methods=['GET'])
+def getTokenKeySet():
+    """Keys for token verification, the current one and recently retired ones."""
+    certMng.refresh()
+    return certMng.publishedKeySet().respond()
+
+
+@app.route("/cert/rotate", methods=['POST'])
+def rotateTokenKey():
+    """Start signing tokens with a new key.
+
+    Expects {"token": KEY_ROTATION_SECRET}.
+    """
+    if not KEY_ROTATION_SECRET:
+        abort(404)
+    token = request.json.get('token') if request.json else None
+    if not isinstance(token, basestring) or \
+       not hmac.compare_digest(toBytes(token), toBytes(KEY_ROTATION_SECRET)):
+        abort(401)
+    certMng.rotate()
+    return nice_json({'kid': certMng.kid}), 200
+
+
+def toBytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+@app.route("/metrics", methods=['GET'])
+def getMetrics():
+    response = make_response(metrics.render())
+    response.headers['Content-type'] = metrics.CONTENT_TYPE
+    return response
 
 
 @app.errorhandler(Exception)
@@ -56,36 +170,165 @@ def all_exception_handler(error):
     return 'Error', 500
 
 
-def nice_json(arg):
-    """Form JSON responses."""
-    response = make_response(json.dumps(arg, sort_keys = True, indent=4))
-    response.headers['Content-type'] = "application/json"
-    return response
+class CertMng():
+    """Manages the key pair and certificate used to sign tokens.
 
+    The key type follows the token signing algorithm: RSA 2048 for RS* and
+    PS*, ECDSA on the matching NIST curve for ES*.
 
-class CertMng():
-    """docstring for CertManager"""
-    def __init__(self):
+    Keys are identified by their JWK thumbprint (kid). When the key is
+    rotated, the certificate of the previous key is kept in 'retired' for
+    as long as tokens signed with it may still be valid. Worker processes
+    pick up a rotation done by another worker from the files on disk.
+
+    The /cert/pem and /cert/jwks responses are encoded when the key pair
+    is loaded, not per request.
+    """
+    def __init__(self, algorithm=JWT_ALGORITHM):
         self.sslConfigFile = 'openssl-service.cnf' # Basic SSL config.
         self.keyFile = 'servicekey.pem' # Private key
         self.certFile = 'servicecert.pem' # Certificate
+        self.retiredDir = 'retired' # Certificates of previous keys
+        self.algorithm = algorithm
+        self.lock = threading.Lock()
+        self.checked = 0
 
         self.generate()
-
-    def generate(self):
+        self.load()
+
+    def load(self):
+        """Parse the current key pair once, for signing and publishing."""
+        with open(self.keyFile, 'rb') as f:
+            self.key = serialization.load_pem_private_key(f.read(), None,
+                                                          default_backend())
+        self.mtime = os.stat(self.certFile).st_mtime
+        with open(self.certFile, 'rb') as f:
+            self.certPem = f.read()
+        self.jwk = self.toJwk(self.key.public_key(), self.certPem)
+        self.kid = self.jwk['kid']
+        # Replaced as a whole, so a signer never pairs a key with another kid
+        self.signingKey = (self.key, self.kid)
+        self.published = StaticResponse({'PEM': self.certPem,
+                                         'alg': self.algorithm,
+                                         'kid': self.kid})
+        self.keySetResponse = None
+
+    def publishedKeySet(self):
+        """Response with keySet(), built again after KEY_SET_REFRESH."""
+        cached = self.keySetResponse
+        if cached is None or time.time() - cached[0] > KEY_SET_REFRESH:
+            cached = (time.time(), StaticResponse(self.keySet()))
+            self.keySetResponse = cached
+        return cached[1]
+
+    def refresh(self):
+        """Reload the key pair if another process rotated it.
+
+        Checks the certificate file at most once per second.
+        """
+        now = time.time()
+        if now - self.checked < 1:
+            return
+        self.checked = now
+        try:
+            if os.stat(self.certFile).st_mtime != self.mtime:
+                with self.lock:
+                    self.load()
+        except (IOError, OSError, ValueError) as e:
+            logger.warning("Key pair not reloaded: %s" % e)
+
+    def rotate(self):
+        """Replace the signing key, keep the previous one for verification."""
+        with self.lock:
+            if not os.path.isdir(self.retiredDir):
+                os.makedirs(self.retiredDir)
+            shutil.copyfile(self.certFile,
+                            os.path.join(self.retiredDir, self.kid + '.pem'))
+            self.generate(self.keyFile + '.new', self.certFile + '.new')
+            # The key first: a process that reloads in between sees the
+            # new key with the old certificate and reloads again.
+            os.rename(self.keyFile + '.new', self.keyFile)
+            os.rename(self.certFile + '.new', self.certFile)
+            self.load()
+        logger.info("Token signing key rotated, kid %s" % self.kid)
+
+    def toJwk(self, pubKey, certPem=None):
+        key = publicJwk(pubKey)
+        key['kid'] = thumbprint(key)
+        key['alg'] = self.algorithm
+        key['use'] = 'sig'
+        if certPem:
+            cert = load_pem_x509_certificate(certPem, default_backend())
+            if publicJwk(cert.public_key()) == publicJwk(pubKey):
+                der = cert.public_bytes(serialization.Encoding.DER)
+                key['x5c'] = [base64.b64encode(der).decode('ascii')]
+        return key
+
+    def keySet(self):
+        """JWKS document with the current and the recently retired keys."""
+        keys = [self.jwk]
+        if os.path.isdir(self.retiredDir):
+            oldest = time.time() - \
+                     JWT_ACCESS_TOKEN_EXPIRES.total_seconds() * 2
+            for f in os.listdir(self.retiredDir):
+                path = os.path.join(self.retiredDir, f)
+                try:
+                    if os.stat(path).st_mtime < oldest:
+                        # No token signed with this key is valid any more
+                        os.remove(path)
+                        continue
+                    with open(path, 'rb') as cert:
+                        certPem = cert.read()
+                    pubKey = load_pem_x509_certificate(
+                        certPem, default_backend()).public_key()
+                except (IOError, OSError, ValueError):
+                    continue
+                if publicJwk(pubKey) != publicJwk(self.key.public_key()):
+                    keys.append(self.toJwk(pubKey, certPem))
+        return {'keys': keys}
+
+    def keyAlgorithm(self):
+        """openssl req -newkey argument for the signing algorithm."""
+        keyAlgorithm = KEY_ALGORITHMS.get(self.algorithm,
+                                          KEY_ALGORITHMS.get(self.algorithm[:2]))
+        if keyAlgorithm is None:
+            raise ValueError("Unsupported JWT algorithm: %s" % self.algorithm)
+        return keyAlgorithm
+
+    def generate(self, keyFile=None, certFile=None):
         """Generates a certificate."""
-        if not os.path.exists(self.certFile) \
-           and not os.path.exists(self.keyFile):
+        keyFile = keyFile or self.keyFile
+        certFile = certFile or self.certFile
+        keyAlgorithm = self.keyAlgorithm()
+        if os.path.exists(keyFile) and \
+           not self.isKeyAlgorithm(keyAlgorithm, keyFile):
+            logger.warning("Key does not fit %s, replacing it" % self.algorithm)
+            os.remove(keyFile)
+            if os.path.exists(certFile):
+                os.remove(certFile)
+        if not os.path.exists(certFile) \
+           and not os.path.exists(keyFile):
             if os.path.exists(self.sslConfigFile):
                 info = "/C=NO/ST=Hordaland/L=Bergen/O=UiB/CN=UserAuthTokenService"
-                cmd="openssl req -x509 -config %s -subj %s -newkey rsa:2048 -nodes -keyout %s -out %s" \
-                   % (self.sslConfigFile, info, self.keyFile, self.certFile)
+                cmd="openssl req -x509 -config %s -subj %s -newkey %s -nodes -keyout %s -out %s" \
+                   % (self.sslConfigFile, info, keyAlgorithm, keyFile, certFile)
                 os.system(cmd)
             else:
                 logger.error("SSL configuration file not found")
         else:
             logger.warning("Certificate already exists")
 
+    def isKeyAlgorithm(self, keyAlgorithm, keyFile=None):
+        """Check whether the existing key is of the given type."""
+        with open(keyFile or self.keyFile, 'r') as f:
+            key = serialization.load_pem_private_key(f.read(), None,
+                                                     default_backend())
+        if keyAlgorithm.startswith('rsa'):
+            return isinstance(key, rsa.RSAPrivateKey)
+        curve = keyAlgorithm.rsplit(':', 1)[-1]
+        return isinstance(key, ec.EllipticCurvePrivateKey) and \
+               EC_CURVES.get(curve) == key.curve.name
+
     def remove(self):
         """Remove existent certificates."""
         filelist = [f for f in os.listdir('.') \
@@ -108,41 +351,53 @@ class CertMng():
             logger.error("SSL certificate not found")
 
 
-certMng = CertMng()
-
-def isDocker():
-    """Determines if we are running inside Docker.
+class TokenIssuer():
+    """Issues access tokens signed with the current key of a CertMng.
 
-    The process's PID inside the container differs from it's PID on the host
-    (a non-container system).
+    The claims are those of Flask-JWT-Extended access tokens; the header
+    carries the 'kid' of the signing key so that verifiers can pick the
+    right key from /cert/jwks.
     """
-    procList = ""
-    if os.path.isfile('/proc/1/cgroup'):
-        with open('/proc/1/cgroup', 'rt') as f:
-            procList = f.read()
-    procList = procList.decode('utf-8').lower()
-    checks = [
-        'docker' in procList,
-        '/lxc/' in procList,
-        procList and procList.split()[0] not in ('systemd', 'init',),
-        os.path.exists('/.dockerenv'),
-        os.path.exists('/.dockerinit'),
-        os.getenv('container', None) is not None
-    ]
-    return any(checks)
+    def __init__(self, certMng, expires=JWT_ACCESS_TOKEN_EXPIRES):
+        self.certMng = certMng
+        self.expires = expires
+
+    def issue(self, identity):
+        with issueLatency.time():
+            token = self._issue(identity)
+        tokensIssued.inc()
+        return token
+
+    def _issue(self, identity):
+        self.certMng.refresh()
+        now = datetime.datetime.utcnow()
+        claims = {'jti': str(uuid.uuid4()),
+                  'iat': now,
+                  'nbf': now,
+                  'exp': now + self.expires,
+                  'identity': identity,
+                  'fresh': False,
+                  'type': 'access'}
+        key, kid = self.certMng.signingKey
+        token = jwt.encode(claims, key, algorithm=self.certMng.algorithm,
+                           headers={'kid': kid})
+        return token.decode('utf-8')
+
+
+certMng = CertMng()
+tokenIssuer = TokenIssuer(certMng)
 
 def main():
-    if isDocker():
+    if config.isDocker():
         FLASK_PORT = 80
     else:
         FLASK_PORT = 8081
-    # Setup the Flask-JWT-Extended extension
-    app.config['JWT_ALGORITHM'] = 'RS256'
-    # Default expiration time is 15 minutes
-    app.config['JWT_ACCESS_TOKEN_EXPIRES'] = datetime.timedelta(seconds=60*10)
-    app.config['JWT_PRIVATE_KEY'] = certMng.getKey()
-    app.config['JWT_PUBLIC_KEY'] = certMng.getCert()
-    jwt = JWTManager(app)
+    # Not TOKEN_PORT, which is how clients reach the STS
+    FLASK_PORT = config.get('TOKEN_LISTEN_PORT', FLASK_PORT)
+    if server.SERVER_MODE == 'production':
+        # The token signing key is loaded, and shared by the workers
+        server.runProduction(app, HOST, FLASK_PORT)
+        return
     # Order matters!
     #context = ('cacert.pem', 'cakey.pem')
     # Start Flask web server
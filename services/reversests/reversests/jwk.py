@@ -0,0 +1,50 @@
+import json
+import base64
+import hashlib
+import binascii
+
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
+
+
+# cryptography curve names to JWK "crv" values
+JWK_CURVES = {
+    'secp256r1': 'P-256',
+    'secp384r1': 'P-384',
+    'secp521r1': 'P-521',
+}
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def intToB64url(value, length=None):
+    """Big-endian, unpadded base64url form of an integer (RFC 7518)."""
+    if length is None:
+        length = max(1, (value.bit_length() + 7) // 8)
+    return b64url(binascii.unhexlify('%0*x' % (length * 2, value)))
+
+
+def publicJwk(pubKey):
+    """Public JWK members of an RSA or EC public key."""
+    if isinstance(pubKey, rsa.RSAPublicKey):
+        numbers = pubKey.public_numbers()
+        return {'kty': 'RSA',
+                'n': intToB64url(numbers.n),
+                'e': intToB64url(numbers.e)}
+    if isinstance(pubKey, ec.EllipticCurvePublicKey):
+        numbers = pubKey.public_numbers()
+        size = (pubKey.curve.key_size + 7) // 8
+        return {'kty': 'EC',
+                'crv': JWK_CURVES[pubKey.curve.name],
+                'x': intToB64url(numbers.x, size),
+                'y': intToB64url(numbers.y, size)}
+    raise ValueError("Unsupported key type: %s" % type(pubKey))
+
+
+def thumbprint(jwk):
+    """RFC 7638 JWK thumbprint, used as the key ID."""
+    required = ('crv', 'e', 'kty', 'n', 'x', 'y')
+    members = dict((k, v) for k, v in jwk.items() if k in required)
+    canonical = json.dumps(members, sort_keys=True, separators=(',', ':'))
+    return b64url(hashlib.sha256(canonical.encode('utf-8')).digest())
@@ -0,0 +1,111 @@
+"""Runtime configuration, resolved once per process.
+
+Settings are taken from the environment and, when MISSFIRE_CONFIG names a
+JSON file, from that file, e.g. {"MTLS": true, "FANOUT_TIMEOUT": 5}. The
+environment wins over the file. Both are read once, by the first
+getConfig(); forked workers inherit the result.
+
+Whether the process runs in a container decides the default addresses
+of the infrastructure services. It is probed on first use only, and not
+at all when IN_DOCKER is set.
+"""
+import os
+import json
+import threading
+
+
+# Values of boolean settings that mean True, in any case
+TRUE_VALUES = ('true', '1', 'yes', 'on')
+
+# Set by the first getConfig()
+config = None
+configLock = threading.Lock()
+
+
+def toBool(value):
+    if isinstance(value, basestring):
+        return value.strip().lower() in TRUE_VALUES
+    return bool(value)
+
+
+def isDocker():
+    """Determines if we are running inside Docker.
+
+    The process's PID inside the container differs from it's PID on the host
+    (a non-container system).
+    """
+    procList = ""
+    if os.path.isfile('/proc/1/cgroup'):
+        with open('/proc/1/cgroup', 'rt') as f:
+            procList = f.read()
+    procList = procList.decode('utf-8').lower()
+    checks = [
+        'docker' in procList,
+        '/lxc/' in procList,
+        procList and procList.split()[0] not in ('systemd', 'init',),
+        os.path.exists('/.dockerenv'),
+        os.path.exists('/.dockerinit'),
+        os.getenv('container', None) is not None
+    ]
+    return any(checks)
+
+
+class Config():
+    """Settings by name.
+
+    get() converts a value to the type of the default: booleans, numbers,
+    and lists given as comma separated strings. A value that is not a
+    number of that type raises a ValueError naming the setting.
+    """
+    def __init__(self, values):
+        self.values = values
+        self.docker = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, environ=None, fileName=None):
+        environ = os.environ if environ is None else environ
+        fileName = fileName or environ.get('MISSFIRE_CONFIG')
+        values = {}
+        if fileName:
+            with open(fileName, 'r') as f:
+                values.update(json.load(f))
+        values.update(environ)
+        return cls(values)
+
+    def get(self, name, default=None):
+        value = self.values.get(name)
+        if value is None or value == '':
+            return default
+        if isinstance(default, bool):
+            return toBool(value)
+        if isinstance(default, (int, long, float)):
+            try:
+                return type(default)(value)
+            except (TypeError, ValueError):
+                raise ValueError("Setting %s: %r is not a valid %s"
+                                 % (name, value, type(default).__name__))
+        if isinstance(default, (list, tuple)):
+            if isinstance(value, basestring):
+                value = [item.strip() for item in value.split(',')]
+            return [item for item in value if item]
+        return value
+
+    def isDocker(self):
+        """True in a container, probed once unless IN_DOCKER is set."""
+        with self.lock:
+            if self.docker is None:
+                if self.get('IN_DOCKER') is not None:
+                    self.docker = self.get('IN_DOCKER', False)
+                else:
+                    self.docker = isDocker()
+            return self.docker
+
+
+def getConfig():
+    """Return the configuration of this process, loaded on first use."""
+    global config
+    with configLock:
+        if config is None:
+            config = Config.load()
+        return config